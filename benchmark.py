@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Generates scenarios over line, star, tree and fat-tree topologies with
+# HTTP, FTP or DNS workloads, runs each one in a fresh process and prints
+# one line of measurements per scenario, always with the same columns:
+#
+#   python benchmark.py --nodes 10,100,1000 --workload http,dns --rate 200 \
+#                       -o today.tsv --baseline last_week.tsv
+#
+# Hosts get consecutive /30 networks out of 10.0.0.0/8, so the hosts under
+# any router of a tree are covered by a few prefixes, and routing tables
+# stay small however big the topology is.
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import subprocess
+
+import simulator
+
+TOPOLOGIES = ['line', 'star', 'tree', 'fattree']
+WORKLOADS  = ['http', 'ftp', 'dns', 'mixed']
+
+COLUMNS = ['case', 'topology', 'nodes', 'workload', 'rate', 'requests', 'completed', 'events',
+           'frames', 'simulated_time', 'load_time', 'run_time', 'events_per_second',
+           'peak_rss_kb', 'error']
+
+HOSTS     = 10 << 24                 # 10.0.0.0, host networks
+LINKS     = (100 << 24) | (64 << 16) # 100.64.0.0, ends of links between routers
+HOST_LINK = ('100Mbps', '1ms')
+CORE_LINK = ('1000Mbps', '2ms')
+
+
+# Topologies ##########################################################
+class Topology:
+    def __init__(self):
+        self.hosts   = [] # names, in address order
+        self.routers = [] # [name, interfaces]
+        self.links   = [] # (end, end, (Mbps, delay))
+        self.ips     = {} # router -> {interface: ip}
+        self.routes  = {} # router -> [(network, interface)]
+        self.gateway = {} # host -> ip of its router
+        self.link_ip = LINKS
+
+    def router(self, interfaces):
+        name = 'r' + str(len(self.routers))
+        self.routers.append([name, interfaces])
+        self.ips[name]    = {}
+        self.routes[name] = []
+        return name
+
+    # Hosts on interfaces first, first + 1, ... of a router; returns the
+    # range of their indices.
+    def attach_hosts(self, router, first, count):
+        start = len(self.hosts)
+        for k in range(count):
+            index = len(self.hosts)
+            host  = 'h' + str(index)
+            self.hosts.append(host)
+            self.links.append((host, router + '.' + str(first + k), HOST_LINK))
+            self.ips[router][first + k] = int_to_ip(HOSTS + 4 * index + 2)
+            self.gateway[host] = self.ips[router][first + k]
+            self.routes[router].append((int_to_ip(HOSTS + 4 * index) + '/30', first + k))
+        return start, len(self.hosts)
+
+    def connect(self, router1, interface1, router2, interface2):
+        self.links.append((router1 + '.' + str(interface1), router2 + '.' + str(interface2),
+                           CORE_LINK))
+        for router, interface in ((router1, interface1), (router2, interface2)):
+            self.link_ip += 1
+            self.ips[router][interface] = int_to_ip(self.link_ip)
+
+    # Routes the hosts with indices in [start, end) through an interface.
+    def route(self, router, start, end, interface):
+        for network, length in cover(4 * start, 4 * end):
+            self.routes[router].append((int_to_ip(HOSTS + network) + '/' + str(length), interface))
+
+    def default(self, router, interface):
+        self.routes[router].append(('0.0.0.0/0', interface))
+
+    def size(self):
+        return len(self.hosts) + len(self.routers)
+
+
+def int_to_ip(value):
+    return '.'.join(str((value >> shift) & 0xff) for shift in (24, 16, 8, 0))
+
+# Aligned blocks (offset, prefix length) covering the addresses [start, end).
+def cover(start, end):
+    while start < end:
+        size = start & -start if start else 1 << 24
+        while size > end - start:
+            size >>= 1
+        yield start, 32 - size.bit_length() + 1
+        start += size
+
+
+# A chain of routers with `hosts` or more hosts each. A packet crosses at
+# most IPPacket.TTL - 1 routers, so a chain never gets longer than that:
+# more nodes put more hosts on each router.
+def line(nodes, hosts = 4):
+    t = Topology()
+    count   = max(min(nodes // (hosts + 1), simulator.IPPacket.TTL - 1), 1)
+    hosts   = max((nodes - count) // count, hosts)
+    routers = [t.router(hosts + 2) for k in range(count)]
+    ranges  = [t.attach_hosts(router, 0, hosts) for router in routers]
+    for k in range(count - 1):
+        t.connect(routers[k], hosts + 1, routers[k + 1], hosts)
+    for k, router in enumerate(routers):
+        t.route(router, 0, ranges[k][0], hosts)
+        t.route(router, ranges[k][1], len(t.hosts), hosts + 1)
+    return t
+
+# One router with every host on it.
+def star(nodes):
+    t = Topology()
+    hosts  = max(nodes - 1, 1)
+    router = t.router(hosts)
+    t.attach_hosts(router, 0, hosts)
+    return t
+
+# A balanced tree of routers, `fanout` children each, with the hosts on the
+# leaves. Interface `fanout` of every router but the root goes up.
+def tree(nodes, fanout = 4):
+    def routers(depth):
+        return (fanout ** (depth + 1) - 1) // (fanout - 1)
+
+    depth = 0
+    while routers(depth + 1) + fanout ** (depth + 1) <= nodes:
+        depth += 1
+    hosts = max((nodes - routers(depth)) // fanout ** depth, 1)
+
+    t = Topology()
+    def build(level):
+        if level == depth:
+            router = t.router(hosts + 1 if level else hosts)
+            start, end = t.attach_hosts(router, 0, hosts)
+            if level:
+                t.default(router, hosts)
+            return router, start, end
+
+        router = t.router(fanout + 1)
+        start  = len(t.hosts)
+        for k in range(fanout):
+            child, child_start, child_end = build(level + 1)
+            t.connect(router, k, child, hosts if level + 1 == depth else fanout)
+            t.route(router, child_start, child_end, k)
+        if level:
+            t.default(router, fanout)
+        return router, start, len(t.hosts)
+
+    build(0)
+    return t
+
+# k-ary fat-tree: k pods of k/2 edge and k/2 aggregation switches, (k/2)^2
+# core switches and k/2 hosts per edge switch. Routing is static, so each
+# switch sends upwards through a single port. The smallest one, k = 4, has
+# 36 nodes; with k = 2 there would be no clients.
+def fattree(nodes):
+    k = 4
+    while (k + 2) ** 3 // 4 + 5 * (k + 2) ** 2 // 4 <= nodes:
+        k += 2
+    half = k // 2
+
+    t = Topology()
+    cores = [t.router(k) for c in range(half * half)]
+    pods  = []
+    for pod in range(k):
+        aggregations = [t.router(k) for a in range(half)]
+        edges        = [t.router(k) for e in range(half)]
+        ranges = [t.attach_hosts(edge, 0, half) for edge in edges]
+        for e, edge in enumerate(edges):
+            for a, aggregation in enumerate(aggregations):
+                t.connect(edge, half + a, aggregation, e)
+                t.route(aggregation, ranges[e][0], ranges[e][1], e)
+            t.default(edge, half + e % half)
+        for a, aggregation in enumerate(aggregations):
+            for c in range(half):
+                t.connect(aggregation, half + c, cores[a * half + c], pod)
+            t.default(aggregation, half + pod % half)
+        pods.append((ranges[0][0], ranges[-1][1]))
+
+    for c, core in enumerate(cores):
+        for pod, (start, end) in enumerate(pods):
+            t.route(core, start, end, pod)
+    return t
+
+BUILDERS = {'line' : line, 'star' : star, 'tree' : tree, 'fattree' : fattree}
+
+
+# Scenarios ###########################################################
+
+# Host 0 is the DNS server, every tenth host a server and the others
+# clients. Requests are spread evenly over the clients and start at random
+# times of the first `duration` seconds.
+def scenario(t, workload, rate, duration, seed, object_path, routes = True):
+    generator = random.Random(seed)
+    lines = ['set ' + host + ' [$simulator host]' for host in t.hosts]
+    lines += ['set %s [$simulator router %d]' % (router, interfaces)
+              for router, interfaces in t.routers]
+    lines += ['$simulator duplex-link $%s $%s %s %s' % (end1, end2, Mbps, delay)
+              for end1, end2, (Mbps, delay) in t.links]
+
+    dns = int_to_ip(HOSTS + 1)
+    for index, host in enumerate(t.hosts):
+        lines.append('$simulator $%s %s %s %s' % (host, int_to_ip(HOSTS + 4 * index + 1),
+                                                  t.gateway[host], dns))
+    for router, interfaces in t.routers:
+        ips = t.ips[router]
+        lines.append('$simulator $%s %s' % (router, ' '.join('%d %s' % (interface, ips[interface])
+                                                             for interface in sorted(ips))))
+        if routes:
+            lines.append('$simulator $%s route %s' % (router, ' '.join('%s %d' % route
+                                                                       for route in t.routes[router])))
+        lines.append('$simulator $%s performance 10us %s' %
+                     (router, ' '.join('%d 1000' % k for k in range(interfaces))))
+
+    hosts   = range(1, len(t.hosts))
+    servers = [index for index in hosts if index % 10 == 5] or list(hosts[:1])
+    clients = [index for index in hosts if not index in servers]
+    agents  = {0 : 'DNSServer'}
+    for position, index in enumerate(servers):
+        ftp = workload == 'ftp' or workload == 'mixed' and position % 2
+        agents[index] = 'FTPServer' if ftp else 'HTTPServer'
+    http = [index for index in servers if agents[index] == 'HTTPServer']
+    ftp  = [index for index in servers if agents[index] == 'FTPServer']
+    for position, index in enumerate(clients):
+        agents[index] = 'FTPClient' if ftp and (not http or position % 2) else 'HTTPClient'
+
+    for index in sorted(agents):
+        lines.append('set a%d [new Agent/%s]' % (index, agents[index]))
+        lines.append('$simulator attach-agent $a%d $%s' % (index, t.hosts[index]))
+
+    count    = int(rate * duration) if clients and servers else 0
+    commands = []
+    for k in range(count):
+        client = clients[k % len(clients)]
+        if agents[client] == 'FTPClient':
+            server  = int_to_ip(HOSTS + 4 * generator.choice(ftp) + 1)
+            command = generator.choice(['GET', 'PUT'])
+        else:
+            server  = generator.choice(http)
+            if workload == 'dns' or workload == 'mixed' and k % 2:
+                server = t.hosts[server] # by name, through the DNS server
+            else:
+                server = int_to_ip(HOSTS + 4 * server + 1)
+            command = 'GET'
+        commands.append((0.1 + generator.random() * duration, client, command, server))
+
+    for at, client, command, server in sorted(commands):
+        lines.append('$simulator at %.6f "a%d %s %s %s"' % (at, client, command, server, object_path))
+    lines.append('$simulator at %.6f "finish"' % (duration + 5.0))
+    return lines, len(commands)
+
+
+# Runs one scenario and writes its measurements to stdout as JSON, with
+# the requests that got their answer.
+def measure(file_name, seed, routing):
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    s = simulator.Simulator('heap', seed, routing = routing)
+    start = loaded = time.time()
+    try:
+        s.load(file_name)
+        loaded = time.time()
+        s.run()
+        error = '-'
+    except Exception as e:
+        error = e.__class__.__name__ + ': ' + str(e)
+    ran = time.time()
+    summary   = s.summary()
+    completed = sum(agent.completed for agent in
+                    s.get_all((simulator.HTTPClient, simulator.FTPClient)))
+    json.dump({'completed'      : completed,
+               'events'         : summary['events'],
+               'frames'         : summary['frames'],
+               'simulated_time' : summary['time'],
+               'load_time'      : loaded - start,
+               'run_time'       : ran - loaded,
+               'peak_rss_kb'    : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               'error'          : error}, stdout)
+
+
+# Runs a scenario in a new interpreter: a forked process would start with
+# the memory of the topologies built before, and report it as its own.
+def run_case(file_name, seed, timeout, routing):
+    command = [sys.executable, os.path.abspath(__file__), '--measure', file_name,
+               '--seed', str(seed)]
+    if routing:
+        command += ['--routing', routing]
+    process = subprocess.Popen(command, stdout = subprocess.PIPE)
+    deadline = time.time() + timeout
+    while process.poll() is None and time.time() < deadline:
+        time.sleep(0.05)
+    if process.poll() is None:
+        process.kill()
+        process.wait()
+        return {'error' : 'timeout after ' + str(timeout) + ' s'}
+    output = process.stdout.read()
+    if process.returncode != 0 or not output:
+        return {'error' : 'exit status ' + str(process.returncode)}
+    return json.loads(output)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return '%.6g' % value
+    return str(value)
+
+def read_results(file_name):
+    f = open(file_name)
+    names = f.readline().rstrip('\n').split('\t')
+    rows  = dict((row[0], dict(zip(names, row))) for row in
+                 (line.rstrip('\n').split('\t') for line in f if line.strip()))
+    f.close()
+    return rows
+
+def compare(rows, baseline, output):
+    output.write('\t'.join(['case', 'events_per_second', 'change', 'peak_rss_kb', 'change']) + '\n')
+    for row in rows:
+        old = baseline.get(row['case'])
+        if old is None or row['error'] != '-' or old['error'] != '-':
+            continue
+        line = [row['case']]
+        for name in ('events_per_second', 'peak_rss_kb'):
+            line += [format_value(row[name]),
+                     '%+.1f%%' % (100.0 * (float(row[name]) / float(old[name]) - 1))]
+        output.write('\t'.join(line) + '\n')
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(usage = 'python benchmark.py [options]')
+    parser.add_argument('--topology', default = ','.join(TOPOLOGIES),
+                        help = 'comma separated, among ' + ', '.join(TOPOLOGIES) + ' (default: all)')
+    parser.add_argument('--nodes', default = '10,100,1000',
+                        help = 'approximate hosts plus routers of each topology (default: 10,100,1000)')
+    parser.add_argument('--workload', default = 'http',
+                        help = 'comma separated, among ' + ', '.join(WORKLOADS) + ' (default: http)')
+    parser.add_argument('--rate', default = '100',
+                        help = 'requests per simulated second, comma separated (default: 100)')
+    parser.add_argument('--duration', type = float, default = 1.0,
+                        help = 'simulated seconds in which requests start (default: 1)')
+    parser.add_argument('--object-size', type = int, default = 10000,
+                        help = 'bytes of the object requested (default: 10000)')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--timeout', type = float, default = 600,
+                        help = 'wall seconds allowed to each scenario (default: 600)')
+    parser.add_argument('--keep', metavar = 'DIR',
+                        help = 'write the generated scenarios to DIR and keep them')
+    parser.add_argument('--baseline', metavar = 'FILE',
+                        help = 'results of an earlier run, to compare with on stderr')
+    parser.add_argument('-o', '--output', help = 'results file (default: stdout)')
+    parser.add_argument('--routing', choices = ['delay', 'bandwidth'],
+                        help = 'leave the route lines out and let the simulator compute the routes')
+    parser.add_argument('--measure', metavar = 'FILE', help = argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.measure:
+        measure(args.measure, args.seed, args.routing)
+        return
+
+    topologies = args.topology.split(',')
+    workloads  = args.workload.split(',')
+    for name in topologies:
+        if not name in BUILDERS:
+            parser.error('unknown topology ' + name)
+    for name in workloads:
+        if not name in WORKLOADS:
+            parser.error('unknown workload ' + name)
+
+    directory = args.keep or tempfile.mkdtemp(prefix = 'benchmark-')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    object_path = os.path.abspath(os.path.join(directory, 'object-' + str(args.object_size)))
+    f = open(object_path, 'wb')
+    f.write(b'x' * args.object_size)
+    f.close()
+
+    output = sys.stdout
+    if args.output:
+        output = open(args.output, 'w')
+    output.write('\t'.join(COLUMNS) + '\n')
+
+    rows = []
+    for topology in topologies:
+        for nodes in [int(n) for n in args.nodes.split(',')]:
+            t = BUILDERS[topology](nodes)
+            for workload in workloads:
+                for rate in [float(r) for r in args.rate.split(',')]:
+                    case = '%s-%d-%s-%g' % (topology, nodes, workload, rate)
+                    lines, requests = scenario(t, workload, rate, args.duration, args.seed,
+                                               object_path, not args.routing)
+                    file_name = os.path.join(directory, case + '.txt')
+                    f = open(file_name, 'w')
+                    f.write('\n'.join(lines) + '\n')
+                    f.close()
+
+                    result = run_case(file_name, args.seed, args.timeout, args.routing)
+                    if not args.keep:
+                        os.remove(file_name)
+
+                    row = {'case' : case, 'topology' : topology, 'nodes' : t.size(),
+                           'workload' : workload, 'rate' : rate, 'requests' : requests}
+                    for name in COLUMNS[6:]:
+                        row[name] = result.get(name, '-')
+                    # Requests lost to the TTL, or still going at the finish,
+                    # make the measurements of a different workload.
+                    if row['completed'] != '-' and row['completed'] < requests and \
+                       row['error'] == '-':
+                        row['error'] = 'incomplete: %d of %d requests' % (row['completed'], requests)
+                    if result.get('run_time'):
+                        row['events_per_second'] = result['events'] / result['run_time']
+                    else:
+                        row['events_per_second'] = '-'
+                    row = dict((name, format_value(value)) for name, value in row.items())
+                    rows.append(row)
+                    output.write('\t'.join(row[name] for name in COLUMNS) + '\n')
+                    output.flush()
+
+    if args.output:
+        output.close()
+    if not args.keep:
+        os.remove(object_path)
+        os.rmdir(directory)
+    if args.baseline:
+        compare(rows, read_results(args.baseline), sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
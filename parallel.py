@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Conservative parallel execution of a scenario.
+#
+# Hosts and routers are split among worker processes, cutting only links
+# whose delay is at least the lookahead L. A frame sent over a cut link at
+# time t reaches the other side at t + L or later, so all workers can
+# safely process the window [T, T + L), T being the earliest pending event
+# of the whole simulation, before exchanging the frames that cross
+# partitions. Every worker loads the whole scenario but only runs the events
+# of the entities it owns.
+#
+# Events are ordered by (time, identifier) and identifiers are numbered per
+# creator entity, so every entity goes through exactly the same events as
+# in the sequential engine. Sniffer records and frame ids are merged back
+# into sequential order by this (master) process, which also writes the
+# sniffer files.
+#
+#   python parallel.py --workers 4 entry.txt
+
+import os
+import sys
+import argparse
+import multiprocessing
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import simulator
+
+
+# Partitioning ########################################################
+class Partition:
+    def __init__(self, scenario, workers):
+        self.owner     = {} # host or router identifier -> worker
+        self.lookahead = float('inf')
+
+        nodes = [entity.identifier for entity in scenario.entities.values()
+                    if isinstance(entity, (simulator.Host, simulator.Router))]
+        links = scenario.links
+
+        # Largest delay threshold that still splits the graph in enough
+        # components: links faster than it are never cut.
+        components = [nodes]
+        for threshold in sorted(set(link.delay for link in links), reverse = True):
+            components = Partition.components(nodes, links, threshold)
+            if len(components) >= workers:
+                break
+        if len(components) < workers:
+            components = [nodes]
+
+        # Biggest components first, each to the least loaded worker.
+        loads = [0] * workers
+        for component in sorted(components, key = len, reverse = True):
+            worker = loads.index(min(loads))
+            loads[worker] += len(component)
+            for identifier in component:
+                self.owner[identifier] = worker
+        self.workers = len([load for load in loads if load])
+
+        for link in links:
+            if self.owner[link.extreme1.identifier] != self.owner[link.extreme2.identifier]:
+                self.lookahead = min(self.lookahead, link.delay)
+
+    @staticmethod
+    def components(nodes, links, threshold):
+        parent = dict((node, node) for node in nodes)
+
+        def find(node):
+            while parent[node] != node:
+                parent[node] = parent[parent[node]]
+                node = parent[node]
+            return node
+
+        for link in links:
+            if link.delay < threshold:
+                parent[find(link.extreme1.identifier)] = find(link.extreme2.identifier)
+
+        groups = {}
+        for node in nodes:
+            groups.setdefault(find(node), []).append(node)
+        return groups.values()
+
+
+# Worker side #########################################################
+
+# Channel towards an entity owned by another worker: the frame is posted
+# when it enters the link, to be delivered there at its arrival time.
+class RemoteChannel(simulator.Channel):
+    def __init__(self, channel, outbox):
+        simulator.Channel.__init__(self, channel.link, channel.sender,
+                                   channel.receiver, channel.interface)
+        self.sniffers = channel.sniffers
+        self.outbox   = outbox
+
+    def transmit(self, frame, event_time):
+        event = simulator.Channel.transmit(self, frame, event_time)
+        self.outbox.append((event.time, event.identifier, self.receiver.entity.identifier,
+                            self.interface, pickle.dumps(frame, 2)))
+        return event
+
+    def deliver(self, frame, time):
+        return
+
+
+# Second half of a frame crossing partitions, with the identifier of the
+# event that ends the transmission on the sender side.
+class ArrivalEvent(simulator.Event):
+    def __init__(self, time, identifier, command):
+        self.identifier = identifier
+        simulator.Event.__init__(self, "message", time, command)
+
+    def prepare_event(self):
+        return
+
+
+# Keeps what it sniffs for the master instead of writing it.
+class RecordingSniffer(simulator.Sniffer):
+    def open(self, file_name, file_format):
+        return
+
+    def write(self, frame, time, ttl):
+        self.simulator.record(self, frame, time, ttl)
+
+    def finish(self):
+        return
+
+
+class PartitionSimulator(simulator.Simulator):
+    def __init__(self, scheduler, seed, owned, keep_frames, routing = None):
+        simulator.Simulator.__init__(self, scheduler, seed, routing = routing)
+        self.owned    = owned
+        self.keep_frames = keep_frames # only needed to number sniffed frames
+        self.outbox   = []
+        self.records  = []
+        self.frames   = [] # creation keys of the frames made in this window
+        self.current  = None
+        self.step     = 0
+        self.arrivals = 0
+
+    def create_agent(self, class_name, identifier):
+        if class_name == 'Sniffer':
+            return RecordingSniffer(identifier)
+        return simulator.Simulator.create_agent(self, class_name, identifier)
+
+    def load(self, file_name, cache = None):
+        simulator.Simulator.load(self, file_name, cache)
+
+        for link in self.links:
+            for channel in (link.channel1, link.channel2):
+                if channel.sender.identifier in self.owned and \
+                   not channel.receiver.entity.identifier in self.owned:
+                    remote = RemoteChannel(channel, self.outbox)
+                    if channel is link.channel1:
+                        link.channel1 = remote
+                    else:
+                        link.channel2 = remote
+
+        # Keeps only the commands of agents on owned hosts.
+        events = []
+        while not self.events.empty():
+            events.append(self.events.get_next())
+        for event in events:
+            if event.command == "finish" or event.entity.host.identifier in self.owned:
+                self.events.add(event)
+
+        for router in self.get_all(simulator.Router):
+            router.compile_table()
+
+    # A frame is identified by the event that made it, so the master can
+    # number frames exactly as the sequential engine does.
+    def get_new_frame_id(self):
+        self.frame_id += 1
+        self.step     += 1
+        key = (self.time, self.current, self.step)
+        if self.keep_frames:
+            self.frames.append(key)
+        return key
+
+    def record(self, sniffer, frame, time, ttl):
+        self.step += 1
+        self.records.append(((self.time, self.current, self.step), sniffer.identifier,
+                             time, ttl, pickle.dumps(frame, 2)))
+
+    def receive(self, message):
+        time, identifier, receiver, interface, frame = message
+        link_layer = self.get(receiver).link_layer
+        frame      = pickle.loads(frame)
+
+        # Counted once processed: arrivals left after the finish are not.
+        def arrive(event):
+            self.arrivals += 1
+            link_layer.receive_from_link(frame, interface, event.time)
+
+        ArrivalEvent(time, identifier, arrive)
+
+    def run_window(self, end):
+        previous = self.activate()
+        try:
+            while not self.events.empty() and self.events.next_time() < end:
+                event = self.events.get_next()
+                self.current = event.identifier
+                self.step    = 0
+                event.process()
+                self.processed_events += 1
+        finally:
+            simulator.Simulator.active = previous
+
+    def next_time(self):
+        if self.events.empty():
+            return None
+        return self.events.next_time()
+
+
+def work(connection, file_name, scheduler, seed, owned, keep_frames, cache, routing):
+    sys.stdout = open(os.devnull, 'w')
+
+    s = PartitionSimulator(scheduler, seed, owned, keep_frames, routing)
+    s.load(file_name, cache)
+    connection.send(s.next_time())
+
+    while True:
+        command = connection.recv()
+        if command[0] == 'stop':
+            break
+
+        _, end, inbox = command
+        previous = s.activate()
+        try:
+            for message in inbox:
+                s.receive(message)
+        finally:
+            simulator.Simulator.active = previous
+
+        s.run_window(end)
+        connection.send((s.outbox[:], s.records, s.frames, s.next_time(), s.finished))
+        del s.outbox[:]
+        s.records = []
+        s.frames  = []
+
+    summary = s.summary()
+    summary['events'] -= s.arrivals # both halves of a crossing count once
+    queues = {}
+    for router in s.get_all(simulator.Router):
+        if router.identifier in owned:
+            queues[router.identifier] = [(queue.dropped, queue.peak) for queue in router.packet_queue]
+    connection.send((summary, queues))
+    connection.close()
+
+
+# Master side #########################################################
+# With a cache, the entry compiled by the master is loaded by the workers
+# without parsing it again.
+def run(file_name, workers, scheduler = 'heap', seed = None, cache = None, routing = None):
+    scenario = simulator.Simulator(scheduler, seed)
+    scenario.load(file_name, cache)
+    partition = Partition(scenario, workers)
+
+    sniffers    = scenario.get_all(simulator.Sniffer)
+    connections = []
+    processes   = []
+    for worker in range(partition.workers):
+        owned = set(identifier for identifier, owner in partition.owner.items() if owner == worker)
+        for agent in scenario.get_all(simulator.Agent):
+            if hasattr(agent, 'host') and agent.host.identifier in owned:
+                owned.add(agent.identifier)
+
+        parent, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target = work,
+                    args = (child, file_name, scheduler, seed, owned, bool(sniffers), cache,
+                            routing))
+        process.start()
+        connections.append(parent)
+        processes.append(process)
+
+    next_times = [connection.recv() for connection in connections]
+    inboxes    = [[] for connection in connections]
+    frame_ids  = {}
+    frames     = 0
+    finished   = False
+    windows    = 0
+
+    while not finished:
+        times = [time for time in next_times if time is not None]
+        times += [message[0] for inbox in inboxes for message in inbox]
+        if not times:
+            break
+        end = min(times) + partition.lookahead
+
+        for worker, connection in enumerate(connections):
+            connection.send(('window', end, inboxes[worker]))
+            inboxes[worker] = []
+        windows += 1
+
+        records = []
+        created = []
+        for worker, connection in enumerate(connections):
+            outbox, worker_records, worker_frames, next_times[worker], done = connection.recv()
+            for message in outbox:
+                inboxes[partition.owner[message[2]]].append(message)
+            records += worker_records
+            created += worker_frames
+            finished = finished or done
+
+        # Frames are numbered in the order the sequential engine makes them.
+        for key in sorted(created):
+            frames += 1
+            frame_ids[key] = frames
+
+        scenario.activate()
+        for key, sniffer, time, ttl, frame in sorted(records):
+            frame    = pickle.loads(frame)
+            frame.id = frame_ids[frame.id]
+            scenario.time = key[0]
+            scenario.get(sniffer).write(frame, time, ttl)
+
+    summary = {}
+    for connection in connections:
+        connection.send(('stop',))
+    for connection in connections:
+        worker_summary, queues = connection.recv()
+        for name, value in worker_summary.items():
+            if name.startswith('max_') or name == 'time':
+                summary[name] = max(summary.get(name, value), value)
+            else:
+                summary[name] = summary.get(name, 0) + value
+        for identifier, counters in queues.items():
+            for queue, (dropped, peak) in zip(scenario.get(identifier).packet_queue, counters):
+                queue.dropped = dropped
+                queue.peak    = peak
+    for process in processes:
+        process.join()
+
+    if finished: # every worker ran its own copy of "finish"
+        summary['events'] -= partition.workers - 1
+    summary['windows']   = windows
+    summary['workers']   = partition.workers
+    summary['lookahead'] = partition.lookahead
+    if finished:
+        scenario.finish()
+    elif scenario.sniffer_writer:
+        scenario.sniffer_writer.flush()
+    simulator.Simulator.active = None
+    return summary
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(usage = 'python parallel.py [options] file_name')
+    parser.add_argument('file_name')
+    parser.add_argument('-j', '--workers', type = int, default = multiprocessing.cpu_count(),
+                        help = 'worker processes (default: one per core)')
+    parser.add_argument('--scheduler', choices = sorted(simulator.schedulers), default = 'heap',
+                        help = 'event queue implementation (default: heap)')
+    parser.add_argument('--seed', type = int,
+                        help = 'seed for the random choices of the simulation')
+    parser.add_argument('--echo-sniffers', action = 'store_true',
+                        help = 'also print sniffer logs on stdout')
+    parser.add_argument('--summary', action = 'store_true',
+                        help = 'print run metrics to stderr')
+    parser.add_argument('--routing', choices = ['delay', 'bandwidth'],
+                        help = 'route to every host along the shortest path by this link metric')
+    parser.add_argument('--cache', metavar = 'DIR',
+                        help = 'keep the compiled entry in DIR, and load it from there '
+                               'while the file is unchanged')
+    args = parser.parse_args(argv)
+
+    simulator.echo_sniffers = args.echo_sniffers
+
+    summary = run(args.file_name, args.workers, args.scheduler, args.seed, args.cache,
+                  args.routing)
+    if args.summary:
+        for name in sorted(summary):
+            sys.stderr.write(name + '\t' + str(summary[name]) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,218 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import re
+import gc
 import sys
+import array
+import json
+import math
 import heapq
+import marshal
+import hashlib
+import bisect
+import fnmatch
+import collections
 import traceback
 import random
-
-#Debug - behavior control variables
-debug         = 0
+import argparse
+import mmap
+import struct
+import timeit
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+#Debug - behavior control variables, bound to trace points by main()
+debug         = 0 # print every trace record
 event_pause   = 0
 stack_print   = 0
-shut_sniffers = 0
+echo_sniffers = 0 # also print sniffer logs on stdout
+
+# Payloads ###########################################################
+# Message contents are mostly measured and sliced on their way through
+# the stack, so big ones need not be strings. A MappedPayload is a window
+# over a file mapped in memory (once per process), a VirtualPayload only
+# a byte count. Slicing them copies nothing; the bytes are only made when
+# a sniffer or an application asks for them, with tobytes().
+class Payload(object):
+    __slots__ = ('length',)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        start, stop, step = key.indices(self.length)
+        return self.part(start, max(stop - start, 0))
+
+    # The bytes as text, for the sniffers; tobytes() has the bytes.
+    def __str__(self):
+        data = self.tobytes()
+        if isinstance(data, str): # Python 2
+            return data
+        return data.decode('utf-8', 'replace')
+
+    # Joins a payload that follows this one, if that needs no copy.
+    def join(self, payload):
+        return None
+
+
+class MappedPayload(Payload):
+    __slots__ = ('store', 'path', 'offset')
+
+    def __init__(self, store, path, offset, length):
+        self.store  = store # ContentStore that maps the file
+        self.path   = path
+        self.offset = offset
+        self.length = length
+
+    def map(self):
+        return self.store.map(self.path)
+
+    def part(self, start, length):
+        return MappedPayload(self.store, self.path, self.offset + start, length)
+
+    def join(self, payload):
+        if isinstance(payload, MappedPayload) and payload.path == self.path and \
+           payload.offset == self.offset + self.length:
+            return MappedPayload(self.store, self.path, self.offset, self.length + payload.length)
+        return None
+
+    # The bytes without copying them.
+    def view(self):
+        try:
+            return buffer(self.map(), self.offset, self.length)
+        except NameError: # Python 3
+            return memoryview(self.map())[self.offset:self.offset + self.length]
+
+    def tobytes(self):
+        return self.map()[self.offset:self.offset + self.length]
+
+    # Frames crossing partitions in parallel.py are pickled, and mapped
+    # again by the store of the simulator that takes them.
+    def __getstate__(self):
+        return (self.path, self.offset, self.length)
+
+    def __setstate__(self, state):
+        self.path, self.offset, self.length = state
+        self.store = Simulator.active.contents
+
+
+class VirtualPayload(Payload):
+    __slots__ = ()
+
+    def __init__(self, length):
+        self.length = int(length)
+
+    def part(self, start, length):
+        return VirtualPayload(length)
+
+    def join(self, payload):
+        if isinstance(payload, VirtualPayload):
+            return VirtualPayload(self.length + payload.length)
+        return None
+
+    def tobytes(self):
+        return b'\0' * self.length
+
+    def __str__(self):
+        return '[' + str(self.length) + ' bytes]'
+
+    def __getstate__(self):
+        return self.length
+
+    def __setstate__(self, state):
+        self.length = state
+
+
+# Appends a piece of a message to the ones already received, merging it
+# with the last when it continues it.
+def append_payload(chunks, chunk):
+    if chunks and isinstance(chunks[-1], Payload):
+        joined = chunks[-1].join(chunk)
+        if joined is not None:
+            chunks[-1] = joined
+            return
+    chunks.append(chunk)
+
+def join_payload(chunks):
+    if len(chunks) == 1:
+        return chunks[0]
+    return ''.join(chunk.tobytes() if isinstance(chunk, Payload) else chunk for chunk in chunks)
+
+
+
+# Content store ######################################################
+# Objects served by the HTTP and FTP agents of a simulator, by path. Files
+# are mapped once and shared by every agent; the mappings are kept in LRU
+# order and the least recently used ones are dropped when the mapped bytes
+# go over `capacity` (payloads only refer to them by path, and map them
+# again when needed). Objects uploaded with PUT only live in the store,
+# until the simulator is reset.
+class ContentStore:
+    def __init__(self, capacity = 256 << 20):
+        self.capacity = capacity # bytes
+        self.maps     = collections.OrderedDict() # path -> mmap, least recently used first
+        self.mapped   = 0
+        self.sizes    = {} # path -> file size
+        self.objects  = {} # path -> uploaded content
+        self.hits     = 0
+        self.loads    = 0
+        self.lock     = threading.Lock() # over maps, mapped and the counters
+
+    # The whole object as a payload, or None if there is no such object.
+    def get(self, path):
+        if path in self.objects:
+            return self.objects[path]
+
+        size = self.sizes.get(path)
+        if size is None:
+            if not os.path.isfile(path):
+                return None
+            size = self.sizes[path] = os.path.getsize(path)
+        if not size: # empty files can't be mapped
+            return ''
+        return MappedPayload(self, path, 0, size)
+
+    def put(self, path, content):
+        self.objects[path] = content
+
+    # Sniffed payloads are also mapped by the thread of the SnifferWriter.
+    def map(self, path):
+        with self.lock:
+            data = self.maps.pop(path, None)
+            if data is None:
+                f = open(path, 'rb')
+                data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+                f.close()
+                self.loads  += 1
+                self.mapped += len(data)
+                self.evict()
+            else:
+                self.hits += 1
+            self.maps[path] = data
+            return data
+
+    # Mappings are not closed, only forgotten: views made of them keep
+    # them open while they are in use. Called with the lock held.
+    def evict(self):
+        while self.maps and self.mapped > self.capacity:
+            path, data = self.maps.popitem(last = False)
+            self.mapped -= len(data)
+
+    def reset(self):
+        self.objects = {}
+
+
+# Packets ############################################################
+# Packet classes keep their fields in __slots__: a simulation makes a few
+# of them per message and per hop.
+class Message(object):
+    __slots__ = ('string', 'type')
 
-class Message:
     def __init__(self, string, messageType):
         self.string  = string
         self.type    = messageType
@@ -41,7 +241,7 @@ class Message:
             if len(self) > 200:
                 data += '[Conteudo de mensagem grande demais]\n\n'
             else:
-                data += self.string + '\n\n'
+                data += str(self.string) + '\n\n'
             
 
         elif self.type == "FTP command":
@@ -58,7 +258,7 @@ class Message:
             if len(self) > 200:
                 data += '[Conteudo de arquivo grande demais]\n\n'
             else:
-                data += self.string + '\n\n'
+                data += str(self.string) + '\n\n'
 
         return data
 
@@ -69,16 +269,42 @@ class Message:
         return len(self.string)
 
 # An ethernet frame simple implementation
-class EthernetFrame:
-    id_generator = 1
+class EthernetFrame(object):
+    __slots__ = ('packet', 'size', 'id')
+
+    # Frames are made at every hop and thrown away when they reach the
+    # other side, so delivered frames are kept to be used again.
+    POOL_SIZE = 1024 # 0 turns recycling off
+    pool      = []
+
     def __init__(frame, packet):
         frame.packet = packet
         frame.size   = packet.size + 24 # Ethernet frame is 24 bytes long
-        frame.id     = EthernetFrame.id_generator
-        EthernetFrame.id_generator += 1
+        frame.id     = Simulator.active.get_new_frame_id()
+
+    @staticmethod
+    def new(packet):
+        if EthernetFrame.pool:
+            frame = EthernetFrame.pool.pop()
+            frame.__init__(packet)
+            return frame
+        return EthernetFrame(packet)
+
+    # Only for frames nothing else refers to (sniffed frames are still
+    # waiting to be written).
+    @staticmethod
+    def release(frame):
+        if len(EthernetFrame.pool) < EthernetFrame.POOL_SIZE:
+            frame.packet = None
+            EthernetFrame.pool.append(frame)
 
     def __repr__(self):
-        data = str(self.packet)
+        return self.describe(self.packet.ttl)
+
+    # The TTL of the packet changes at every hop, so sniffers describe the
+    # frame with the TTL it had when it was captured.
+    def describe(self, ttl):
+        data = self.packet.describe(ttl)
         data += '### Camada de Enlace ###\n\n'
         data += '\tTamanho - ' + str(self.size) + '\n'
         return data
@@ -87,7 +313,9 @@ class EthernetFrame:
         return frame.packet
 
 # IP packet implementation
-class IPPacket:
+class IPPacket(object):
+    __slots__ = ('sender', 'receiver', 'ttl', 'protocol', 'transport_packet', 'size')
+
     TTL = 10
 
     def __init__(self, transport_packet, protocol):
@@ -100,6 +328,9 @@ class IPPacket:
 
 
     def __repr__(self):
+        return self.describe(self.ttl)
+
+    def describe(self, ttl):
         data = str(self.transport_packet)
         data += '### Camada de Rede (IP) ###\n'
         data += '\tEndereço IP de origem  - ' + self.sender + '\n'
@@ -113,22 +344,32 @@ class IPPacket:
 
         data += '\tProtocolo - ' + protocol_number + '\n'
         data += '\tTamanho   - ' + str(self.size) + '\n'
-        data += '\tTTL       - ' + str(self.ttl) + '\n\n'
+        data += '\tTTL       - ' + str(ttl) + '\n\n'
         return data
 
     def extract_segment(packet):
         return packet.transport_packet
 
 # TCP packet implementation
-class TCPSegment:
-    def __init__(self, message):
+# kind is "control" (connection set up and tear down), "data" or "ack"
+# (acknowledges data).
+class TCPSegment(object):
+    __slots__ = ('kind', 'ACK', 'SYN', 'FIN', 'PSH', 'sequence_number', 'ack_number',
+                 'origin_port', 'destination_port', 'offset', 'protocol', 'message', 'size')
+
+    MSS = 1460 # largest payload of a data segment; None sends whole messages
+
+    def __init__(self, message, kind = "control"):
+        self.kind = kind
         self.ACK = 0
         self.SYN = 0
         self.FIN = 0
+        self.PSH = 0 # last segment of an application message
         self.sequence_number  = 0
         self.ack_number       = 0
-        # self.origin_port      = 0
-        # self.destination_port = 0
+        self.origin_port      = 0
+        self.destination_port = 0
+        self.offset   = 0 # of a data segment in its application message
         self.protocol = ""
         self.message = message
         self.size = len(message) + 20 # TCP header is 20 bytes long
@@ -151,12 +392,16 @@ class TCPSegment:
         return segment.message
 
     def set_ports(self, source, destination):
-        self.sender_port = source
-        self.receiver_port = destination
+        self.origin_port      = source
+        self.destination_port = destination
+
+# UDP datagram implementation. kind is "DNS response" for answers to DNS
+# queries and "message" otherwise.
+class UDPDatagram(object):
+    __slots__ = ('kind', 'protocol', 'origin_port', 'destination_port', 'message', 'size')
 
-# UDP datagram implementation
-class UDPDatagram:
-    def __init__(self, message):
+    def __init__(self, message, kind = "message"):
+        self.kind     = kind
         self.protocol = "UDP"
         self.origin_port      = 0
         self.destination_port = 0
@@ -173,8 +418,8 @@ class UDPDatagram:
         return data
 
     def set_ports(self, source, destination):
-        self.sender_port = source
-        self.receiver_port = destination
+        self.origin_port      = source
+        self.destination_port = destination
 
     def extract_message(self):
         return self.message
@@ -182,15 +427,15 @@ class UDPDatagram:
 
 # Commands to be executed and packets to be transmitted #############
 class Event:
-    id_generator = 1
-
-    def __init__(self, event_type, time, command):
+    def __init__(self, event_type, time, command, creator = None):
         self.time       = float(time)
         self.command    = command
         self.event_type = event_type
+        self.creator    = creator
+        self.simulator  = Simulator.active
         
         self.prepare_event()
-        Simulator.add_event(self)
+        self.simulator.add_event(self)
 
     def __repr__(event):
         data  = 'Event time: '
@@ -204,19 +449,13 @@ class Event:
 
     def reschedue(event, time):
         event.time = time
-        Simulator.add_event(event)
+        event.simulator.add_event(event)
 
     def process(event):
-        Simulator.time = event.time
-        if event_pause: a = raw_input()
-        if stack_print: traceback.print_stack(file=sys.stdout)
-
+        event.simulator.time = event.time
         if event.event_type == "order": #Simulator entry
             if event.command == "finish":
-                Simulator.finish()
-                print("+-----------------+")
-                print("| Simulation Done |")
-                print("+-----------------+")
+                event.simulator.finish()
                 return
 
             event.entity.do(event.time, event.command)
@@ -226,79 +465,318 @@ class Event:
             event.command(event)
         return
 
-    @staticmethod
-    def get_new_id():
-        identifier = Event.id_generator
-        Event.id_generator += 1
-        return identifier
-
     def prepare_event(self):
-        self.identifier = Event.get_new_id()
+        self.identifier = self.simulator.get_new_event_id(self.creator)
         if self.event_type == "order":
             tokens = self.command.split()
             if not tokens[0] == "finish":
                 self.entity = Entity.get(tokens[0])
 
 
-# PriorityQueue ######################################################
-class EventQueue:
+# Schedulers #########################################################
+# Every scheduler orders events by (time, identifier), so events happening
+# at the same instant are processed in the order they were created.
+class HeapScheduler:
     def __init__(self):
         self.events = []
 
+    def push(self, event):
+        heapq.heappush(self.events, (event.time, event.identifier, event))
+
+    def pop(self):
+        return heapq.heappop(self.events)[2]
+
+    def next_time(self):
+        return self.events[0][0]
+
+    def __len__(self):
+        return len(self.events)
+
+
+# Calendar queue (R. Brown, 1988): events are hashed by time into buckets
+# of fixed width, each bucket being one "day" of a cyclic "year". With the
+# bucket width adjusted to the mean gap between events, push and pop are
+# amortized O(1).
+class CalendarScheduler:
+    MIN_BUCKETS = 2
+
+    def __init__(self):
+        self.size = 0
+        self.build(CalendarScheduler.MIN_BUCKETS, 1.0, 0.0)
+
+    def build(self, buckets_number, width, start):
+        self.buckets_number = buckets_number
+        self.width          = width
+        self.buckets        = [[] for each in range(buckets_number)]
+        self.day            = int(start / width) # current (absolute) bucket
+
+    def push(self, event):
+        self.insert((event.time, event.identifier, event))
+        self.size += 1
+        if self.size > 2 * self.buckets_number:
+            self.resize(2 * self.buckets_number)
+
+    def insert(self, key):
+        day = int(key[0] / self.width)
+        if day < self.day:
+            self.day = day
+        bisect.insort(self.buckets[day % self.buckets_number], key)
+
+    def pop(self):
+        if self.size == 0:
+            raise IndexError('pop from empty scheduler')
+        return self.remove(self.find())
+
+    def next_time(self):
+        return self.find()[0][0]
+
+    # Returns the bucket holding the next event, moving the current day to it.
+    def find(self):
+        # Looks for the next event in the current year.
+        day = self.day
+        end = day + self.buckets_number
+        while day < end:
+            bucket = self.buckets[day % self.buckets_number]
+            if bucket and int(bucket[0][0] / self.width) <= day:
+                self.day = day
+                return bucket
+            day += 1
+
+        # Nothing this year: jumps straight to the earliest event.
+        key      = min(bucket[0] for bucket in self.buckets if bucket)
+        self.day = int(key[0] / self.width)
+        return self.buckets[self.day % self.buckets_number]
+
+    def remove(self, bucket):
+        _, _, event = bucket.pop(0)
+        self.size -= 1
+        if self.size < self.buckets_number // 2 and \
+           self.buckets_number > CalendarScheduler.MIN_BUCKETS:
+            self.resize(self.buckets_number // 2)
+        return event
+
+    def resize(self, buckets_number):
+        keys = [key for bucket in self.buckets for key in bucket]
+        if not keys:
+            self.build(buckets_number, self.width, 0.0)
+            return
+
+        # New width is three times the mean gap between the earliest events.
+        sample = heapq.nsmallest(25, keys)
+        gaps   = [b[0] - a[0] for a, b in zip(sample, sample[1:]) if b[0] > a[0]]
+        width  = self.width
+        if gaps:
+            width = 3 * sum(gaps) / len(gaps)
+
+        self.build(buckets_number, width, sample[0][0])
+        for key in keys:
+            self.buckets[int(key[0] / width) % buckets_number].append(key)
+        for bucket in self.buckets:
+            bucket.sort()
+
+    def __len__(self):
+        return self.size
+
+
+schedulers = {
+    'heap'     : HeapScheduler,
+    'calendar' : CalendarScheduler,
+}
+
+# PriorityQueue ######################################################
+class EventQueue:
+    def __init__(self, scheduler = 'heap'):
+        self.scheduler = schedulers[scheduler]()
+
     def add(self, event):
-        heapq.heappush(self.events, (event.time, event))
+        self.scheduler.push(event)
 
     def get_next(self):
-        _, event = heapq.heappop(self.events)
-        return event
+        return self.scheduler.pop()
+
+    def next_time(self):
+        return self.scheduler.next_time()
 
     def empty(self):
-        return len(self.events) == 0
+        return len(self.scheduler) == 0
 
 # Simulator contains all the program entities and all the
-# commands which will happen #########################################
+# commands which will happen. Each instance is an independent scenario;
+# entities and events created while it loads or runs belong to it.
 class Simulator:
-    entities = {}
-    events = EventQueue()
-
-    @staticmethod
-    def add_entity(identifier, entity):
-        Simulator.entities[identifier] = entity
-
-    @staticmethod
-    def add_event(new_event):
-        Simulator.events.add(new_event)
-
-    @staticmethod
-    def start():
-        while not Simulator.events.empty():
-            Simulator.events.get_next().process()
+    active = None # simulator currently loading or running
+
+    def __init__(self, scheduler = 'heap', seed = None, fluid = None, profile = False,
+                 routing = None):
+        self.scheduler = scheduler
+        self.seed      = seed
+        self.fluid     = fluid # size from which messages are fluid flows
+        self.profile   = profile
+        self.routing   = routing # metric of the automatic routes, if any
+        self.entities  = {}
+        self.contents  = ContentStore()
+        self.tracer    = Tracer() # subscriptions to the trace points
+        self.reset()
+
+    def reset(self):
+        for sniffer in self.get_all(Sniffer):
+            sniffer.finish()
+        self.entities  = {}
+        self.links     = []
+        self.events    = EventQueue(self.scheduler)
+        self.time      = 0.0
+        self.event_id  = 0
+        self.frame_id  = 0
+        self.ranks     = 0
+        self.finished  = False
+        self.processed_events = 0
+        self.host_names       = {} # name -> host, looked up by the DNS servers
+        self.sniffer_writer   = None
+        self.shortest_paths   = None
+        self.fluid_network    = FluidNetwork(self)
+        self.profiler         = Profiler() if self.profile else None
+        self.contents.reset()
+
+    def activate(self):
+        previous = Simulator.active
+        Simulator.active = self
+        return previous
+
+    # Loading only creates objects, so the collector is off meanwhile: it
+    # would go over all of them again and again and free nothing.
+    # The operations of an entry already compiled by a Reader can be given
+    # instead of its file (sweep.py compiles the entry once, and changes
+    # them for each run).
+    def load(self, file_name, cache = None, operations = None):
+        previous  = self.activate()
+        collector = gc.isenabled()
+        gc.disable()
+        try:
+            Reader(file_name, cache).read_entry(operations)
+        finally:
+            if collector:
+                gc.enable()
+            Simulator.active = previous
+
+    def run(self):
+        previous = self.activate()
+        try:
+            for router in self.get_all(Router):
+                router.compile_table()
+            if self.profiler:
+                self.profiler.run(self)
+            else:
+                while not self.events.empty():
+                    self.events.get_next().process()
+                    self.processed_events += 1
+            if self.sniffer_writer:
+                self.sniffer_writer.flush()
+            if self.profiler:
+                self.profiler.report(self)
+        finally:
+            Simulator.active = previous
+
+    def add_entity(self, identifier, entity):
+        self.entities[identifier] = entity
+        self.ranks += 1
+        return self.ranks
+
+    def get_sniffer_writer(self):
+        if self.sniffer_writer is None:
+            self.sniffer_writer = SnifferWriter(echo_sniffers)
+        return self.sniffer_writer
+
+    def get_shortest_paths(self):
+        if self.shortest_paths is None and self.routing:
+            self.shortest_paths = ShortestPaths(self, self.routing)
+        return self.shortest_paths
+
+    def create_agent(self, class_name, identifier):
+        return agent_classes[class_name](identifier)
+
+    def add_link(self, link):
+        self.links.append(link)
+
+    def add_event(self, new_event):
+        self.events.add(new_event)
+
+    # Events are numbered per creator entity (events created while loading
+    # belong to the simulator itself), so the order of simultaneous events
+    # doesn't depend on how the events of different entities interleave.
+    def get_new_event_id(self, creator):
+        if creator is None:
+            self.event_id += 1
+            return self.event_id
+        creator.event_id += 1
+        return (creator.rank << 40) | creator.event_id
+
+    # Each host draws from its own stream, so its choices don't depend on
+    # what the other hosts drew before.
+    def new_random(self, name):
+        if self.seed is None:
+            return random.Random()
+        return random.Random(str(self.seed) + ':' + name)
+
+    def get_new_frame_id(self):
+        self.frame_id += 1
+        return self.frame_id
+
+    def get(self, identifier):
+        return self.entities[identifier]
+
+    def get_all(self, wanted_class):
+        return filter(lambda obj: isinstance(obj, wanted_class),
+                        self.entities.values())
+
+    # Aggregated metrics of the last run.
+    def summary(self):
+        channels = [channel for link in self.links
+                        for channel in (link.channel1, link.channel2)]
+        queues   = [queue for router in self.get_all(Router)
+                        for queue in router.packet_queue]
+        return {
+            'time'              : self.time,
+            'events'            : self.processed_events,
+            'frames'            : self.frame_id,
+            'queued_frames'     : sum(channel.queued_frames for channel in channels),
+            'max_link_queue'    : max([channel.max_queue_depth for channel in channels] + [0]),
+            'forwarded_packets' : sum(queue.dequeued for queue in queues),
+            'dropped_packets'   : sum(queue.dropped for queue in queues),
+            'max_router_queue'  : max([queue.peak for queue in queues] + [0]),
+            'fluid_flows'       : self.fluid_network.started,
+        }
 
-    @staticmethod
-    def finish():
-        while not Simulator.events.empty():
-            Simulator.events.get_next()
-        for sniffer in Entity.get_all(Sniffer):
+    def finish(self):
+        self.finished = True
+        while not self.events.empty():
+            self.events.get_next()
+        for sniffer in self.get_all(Sniffer):
             sniffer.finish()
+        for router in self.get_all(Router):
+            router.report_drops()
+        print("+-----------------+")
+        print("| Simulation Done |")
+        print("+-----------------+")
 
 
 # Abstract Classes ###################################################
 class Entity:
     def __init__(self, word):
         self.identifier = word
-        Simulator.add_entity(self.identifier, self)
+        self.simulator  = Simulator.active
+        self.rank       = self.simulator.add_entity(self.identifier, self)
+        self.event_id   = 0
 
     def get_time(self):
-        return Simulator.time
+        return self.simulator.time
 
     @staticmethod
     def get(identifier):
-        return Simulator.entities[identifier]
+        return Simulator.active.get(identifier)
 
     @staticmethod
     def get_all(wanted_class):
-        return filter(lambda obj: isinstance(obj, wanted_class),
-                        Simulator.entities.values())
+        return Simulator.active.get_all(wanted_class)
 
 
 class Agent(Entity):
@@ -317,14 +795,150 @@ class Agent(Entity):
         f.write(content)
         f.close()
 
+    # An object of the shared content store, by default the agent's file.
+    def content(self, path = None):
+        return self.simulator.contents.get(path or self.__class__.file_name)
+
+    # Calls send with the ip of a host name (or address), asking the DNS
+    # server from port when the host doesn't know it yet.
+    def resolve(self, name, port, send):
+        if '.' in name:
+            send(name)
+            return
+
+        def answered(ip):
+            if ip is None:
+                print("Agente " + self.identifier + ": host " + name + " desconhecido")
+                self.host.transport_layer.release_port(port)
+                return
+            send(ip)
+
+        self.host.resolver.resolve(name, port, answered)
+
+
+# Routing ############################################################
+def ip_to_int(ip):
+    a, b, c, d = ip.split('.')
+    return (int(a) << 24) | (int(b) << 16) | (int(c) << 8) | int(d)
+
+# Parses a route network as (address, prefix length). Networks written
+# without a prefix length ("192.168.1.0") are /24 networks.
+def parse_prefix(network):
+    length = 24
+    if '/' in network:
+        network, length = network.split('/')
+        length = int(length)
+    mask = ((1 << length) - 1) << (32 - length)
+    return (ip_to_int(network) & mask, length)
+
+# Binary trie over address bits, answering longest prefix match queries
+# in at most 32 steps. Nodes are [child 0, child 1, value] lists.
+class PrefixTrie:
+    def __init__(self):
+        self.root = [None, None, None]
+
+    def add(self, network, length, value):
+        node = self.root
+        for shift in range(31, 31 - length, -1):
+            bit = (network >> shift) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        node[2] = value
+
+    def lookup(self, address):
+        node  = self.root
+        value = None
+        shift = 31
+        while node is not None:
+            if node[2] is not None:
+                value = node[2]
+            if shift < 0:
+                break
+            node   = node[(address >> shift) & 1]
+            shift -= 1
+
+        if value is None:
+            raise KeyError(address)
+        return value
+
+# Routes computed from the links, for simulations run with a routing
+# metric: 'delay' (link delays) or 'bandwidth' (the inverse of the link
+# rates). The destination of a packet to a host is the router the host
+# hangs from; the first time a packet goes there, Dijkstra from that
+# router gives every other router its outgoing interface towards it (links
+# cost the same both ways). Those are host routes, so they take precedence
+# over hand-written ones, which remain for the other addresses.
+class ShortestPaths:
+    def __init__(self, simulator, metric):
+        if not metric in ('delay', 'bandwidth'):
+            raise ValueError('unknown routing metric ' + metric)
+        self.routers    = sorted(simulator.get_all(Router), key = lambda router: router.rank)
+        self.index      = dict((router.identifier, k) for k, router in enumerate(self.routers))
+        self.neighbours = [[] for router in self.routers] # (cost, router, its interface back)
+        self.hosts      = {} # host ip -> (router, interface to the host)
+        self.trees      = {} # router -> array of the interface of each router towards it
+
+        for link in simulator.links:
+            cost = link.delay if metric == 'delay' else 1.0 / link.bps
+            end1 = self.index.get(link.extreme1.identifier)
+            end2 = self.index.get(link.extreme2.identifier)
+            if end1 is not None and end2 is not None:
+                self.neighbours[end1].append((cost, end2, link.port2))
+                self.neighbours[end2].append((cost, end1, link.port1))
+            elif end1 is not None:
+                self.hosts[link.extreme2.get_ip()] = (end1, link.port1)
+            elif end2 is not None:
+                self.hosts[link.extreme1.get_ip()] = (end2, link.port2)
+
+    # Interface of router towards ip, or None if ip is not a host.
+    def interface(self, router, ip):
+        host = self.hosts.get(ip)
+        if host is None:
+            return None
+        destination, interface = host
+        k = self.index[router.identifier]
+        if k == destination:
+            return interface
+
+        tree = self.trees.get(destination)
+        if tree is None:
+            tree = self.trees[destination] = self.tree(destination)
+        if tree[k] < 0:
+            raise ValueError('no path from router ' + router.identifier + ' to ' + ip)
+        return tree[k]
+
+    def tree(self, destination):
+        interfaces = array.array('h', [-1]) * len(self.routers)
+        distances  = [float('inf')] * len(self.routers)
+        distances[destination] = 0.0
+        neighbours = self.neighbours
+        heappop    = heapq.heappop
+        heappush   = heapq.heappush
+        heap = [(0.0, destination)]
+        while heap:
+            distance, k = heappop(heap)
+            if distance > distances[k]:
+                continue
+            for cost, neighbour, interface in neighbours[k]:
+                cost += distance
+                if cost < distances[neighbour]:
+                    distances[neighbour]  = cost
+                    interfaces[neighbour] = interface
+                    heappush(heap, (cost, neighbour))
+        return interfaces
+
 
 ######################################################################
 class Host(Entity):
     def __init__(host, word):
         Entity.__init__(host, word)
+        host.random          = host.simulator.new_random(word)
         host.transport_layer = TransportLayer(host)
         host.network_layer   = NetworkLayer(host)
         host.link_layer      = LinkLayer(host)
+        host.resolver        = Resolver(host)
+        host.simulator.host_names[word] = host
 
         host.set_layers()
 
@@ -347,29 +961,124 @@ class Host(Entity):
         host.network_layer.set_ips(my_ip, standard_router, dns_server)
 
     def send_to(host, ip, message, origin_port, destination_port):
-        if debug: print ("giving message: " + message + " to tranport")
         host.transport_layer.send_message(ip, message, origin_port, destination_port)
 
     def close_connection(host, sender, origin_port, destination_port):
         host.transport_layer.close_connection(sender, origin_port, destination_port)
 
-    def proceed_after_query(host, response, query):
-        host.agent.proceed_after_query(response, query)
-        return
-
     def process(host, message, sender, origin_port, destination_port):
         host.agent.receive_message(message, sender, origin_port, destination_port)
         return
 
 
+# DNS cache of a host. Answers are kept for TTL seconds and unknown names
+# for NEGATIVE_TTL seconds of simulated time; while a name is being asked,
+# other requests for it wait for the same answer.
+class Resolver:
+    TTL          = 300.0
+    NEGATIVE_TTL = 30.0
+
+    def __init__(self, host):
+        self.host    = host
+        self.answers = {} # name -> (ip or None, expiry time)
+        self.waiting = {} # name -> functions called with the answer
+
+    def resolve(self, name, port, done):
+        answer = self.answers.get(name)
+        if answer is not None and answer[1] > self.host.get_time():
+            done(answer[0])
+            return
+
+        if name in self.waiting:
+            self.waiting[name].append(done)
+            return
+        self.waiting[name] = [done]
+        datagram = UDPDatagram(Message(name, "DNS query"))
+        self.host.transport_layer.send_datagram_to(self.host.network_layer.dns_server, datagram, port, 53)
+
+    def answer(self, ip, name):
+        ttl = Resolver.TTL if ip is not None else Resolver.NEGATIVE_TTL
+        self.answers[name] = (ip, self.host.get_time() + ttl)
+        for done in self.waiting.pop(name, []):
+            done(ip)
+
+
+# Bounded FIFO of packets waiting at a router interface, each served one
+# delay after it arrived or after the packet before it was. A packet that
+# arrives with `limit` packets in the queue is dropped; the packets of a
+# train are admitted one by one, at their own arrival times. Done times
+# only grow, so the packets still in the queue at any time are counted
+# by bisection, less those of trains that have not arrived yet.
+class PacketQueue:
+    def __init__(self, limit):
+        self.packets  = collections.deque() # (packet or train, done times)
+        self.done     = [] # done time of each packet admitted, the first `served` past
+        self.served   = 0
+        self.coming   = [] # arrival times of packets admitted, sorted, the first `arrived` past
+        self.arrived  = 0
+        self.limit    = limit
+        self.enqueued = 0
+        self.dequeued = 0
+        self.dropped  = 0
+        self.peak     = 0 # highest occupancy
+
+    # Queues what fits of `packet`, arriving at `time`; returns the packet
+    # or train actually queued, or None.
+    def push(self, packet, time, delay):
+        done   = self.done
+        coming = self.coming
+        self.served  = bisect.bisect_right(done, time, self.served)
+        self.arrived = bisect.bisect_right(coming, time, self.arrived)
+        if self.served > len(done) // 2:
+            del done[:self.served]
+            self.served = 0
+        if self.arrived > len(coming) // 2:
+            del coming[:self.arrived]
+            self.arrived = 0
+
+        train    = isinstance(packet, Train)
+        arrivals = packet.times if train else [time]
+        admitted = []
+        times    = []
+        for k, arrival in enumerate(arrivals):
+            length = (len(done) - bisect.bisect_right(done, arrival, self.served) -
+                      len(coming) + bisect.bisect_right(coming, arrival, self.arrived))
+            if length >= self.limit:
+                self.dropped += 1
+                continue
+            done.append(max(arrival, done[-1] if done else 0.0) + delay)
+            if arrival > time:
+                bisect.insort(coming, arrival, self.arrived)
+            self.enqueued += 1
+            self.peak = max(self.peak, length + 1)
+            admitted.append(k)
+            times.append(done[-1])
+
+        if not admitted:
+            return None
+        if train and len(admitted) < len(packet):
+            packet = Train([packet.items[k] for k in admitted], [packet.times[k] for k in admitted])
+        self.packets.append((packet, times))
+        return packet
+
+    # The next packet or train with the times its packets are served.
+    def pop(self):
+        packet, times = self.packets.popleft()
+        self.dequeued += len(times)
+        return packet, times
+
+    def __len__(self):
+        return len(self.done) - self.served
+
+
 class Router(Entity):
     def __init__(self, word, interfaces):
-        self.routing_table = {}
-        self.queue_top             = [0    for each in range(int(interfaces))]
-        self.packet_queue          = [[]   for each in range(int(interfaces))]
+        self.routing_table    = {}
+        self.forwarding_table = None
+        self.route_cache      = {}
+        self.packet_queue          = [PacketQueue(0) for each in range(int(interfaces))]
         self.interface_ip          = [None for each in range(int(interfaces))]
         self.link_at_interface     = [None for each in range(int(interfaces))]
-        self.interface_queue_limit = [None for each in range(int(interfaces))]
         self.transport_layer = None
         
         self.link_layer      = LinkLayer(self)
@@ -386,67 +1095,248 @@ class Router(Entity):
         self.interface_ip[int(interface)] = ip
 
     def set_limit(self, interface, packet_limit):
-        self.interface_queue_limit[int(interface)] = int(packet_limit)
+        self.packet_queue[int(interface)].limit = int(packet_limit)
 
     def set_link(self, interface, link):
         self.link_at_interface[int(interface)] = link
 
     def update_table(self, origin, destination):
-        key = origin[0: origin.rfind('.')]
-        self.routing_table[key] = destination
+        self.add_route(parse_prefix(origin), destination)
+
+    def add_route(self, prefix, destination):
+        self.routing_table[prefix] = destination
+        self.forwarding_table = None
+
+    # Resolves every route to an outgoing interface, following gateways,
+    # so forwarding a packet is a single longest prefix match.
+    def compile_table(self):
+        routes = PrefixTrie()
+        for (network, length), destination in self.routing_table.items():
+            routes.add(network, length, destination)
+
+        self.forwarding_table = PrefixTrie()
+        self.route_cache      = {}
+        for (network, length), destination in self.routing_table.items():
+            gateways = set()
+            while '.' in destination:
+                if destination in gateways:
+                    raise ValueError('routing loop at router ' + self.identifier +
+                                     ' through gateway ' + destination)
+                gateways.add(destination)
+                destination = routes.lookup(ip_to_int(destination))
+            self.forwarding_table.add(network, length, int(destination))
 
     def get_interface_from_table(self, destination):
-        key = destination[0: destination.rfind('.')]
-        while '.' in self.routing_table[key]:
-            key = self.routing_table[key]
-            key = key[0: key.rfind('.')]
-        interface = int(self.routing_table[key])
+        interface = self.route_cache.get(destination)
+        if interface is None:
+            paths = self.simulator.get_shortest_paths()
+            if paths is not None:
+                interface = paths.interface(self, destination)
+            if interface is None:
+                if self.forwarding_table is None:
+                    self.compile_table()
+                interface = self.forwarding_table.lookup(ip_to_int(destination))
+            self.route_cache[destination] = interface
         return interface
 
     def push_packet_into_queue(router, interface, packet):
-        if debug: print ("On Router " + router.__class__.__name__ + " " + router.identifier + ", interface " + str(interface) + ":"),
-        if debug: print ("Packet Arrived")
+        queue    = router.packet_queue[interface]
+        dropped  = queue.dropped
+        queued   = queue.push(packet, router.get_time(), router.delay) # packets beyond the queue limit are lost
+        if queue.dropped != dropped:
+            router.drop_packet(interface, packet, queue.dropped - dropped)
+        if queued is None:
+            return
 
-        if router.queue_top[interface] < router.interface_queue_limit[interface]:
-            router.queue_top[interface] += 1
-            router.packet_queue[interface].append(packet)
-            
-            if router.queue_top[interface] == 1:
-                time = router.get_time() + router.delay
+        if len(queue.packets) == 1:
+            def process_packet(event):
+                packet, times = queue.pop()
+                if isinstance(packet, Train):
+                    packet.times = times
+                    receiver     = packet.items[0].receiver
+                else:
+                    receiver     = packet.receiver
 
-                def process_packet(event):
-                    router.queue_top[interface] -= 1
-                    packet = router.packet_queue[interface].pop(0)
+                if queue.packets:
+                    Event("message", queue.packets[0][1][0], process_packet, router)
 
-                    if router.queue_top[interface] != 0:
-                        Event("message", event.time + router.delay, process_packet)
+                next_interface = router.get_interface_from_table(receiver)
+                router.network_layer.repass_packet(packet, next_interface)
+                return
 
-                    next_interface = router.get_interface_from_table(packet.receiver)
-                    router.network_layer.repass_packet(packet, next_interface)
-                    return
+            Event("message", queue.packets[0][1][0], process_packet, router)
+        return
 
-                Event("message", time, process_packet)
+    # Trace point of the packets lost on full queues (`count` of them, for
+    # a train).
+    def drop_packet(router, interface, packet, count):
+        return
 
-            else:
-                return
+    def report_drops(router):
+        for interface, queue in enumerate(router.packet_queue):
+            if queue.dropped:
+                print ("Roteador " + router.identifier + ", interface " + str(interface) + ": " +
+                       str(queue.dropped) + " pacotes descartados (pico da fila: " + str(queue.peak) + ")")
+
+
+# Back-to-back frames (or packets) of one flow, taken through each link
+# and router by a single event: times[k] is when item k is ready for the
+# next hop. A train holds the channels and queues it goes through until
+# its last item has passed, so other traffic never cuts into it.
+class Train:
+    def __init__(self, items, times):
+        self.items = items
+        self.times = times
+
+    def __len__(self):
+        return len(self.items)
+
+
+# One direction of a link: frames sent by one extreme to the other.
+class Channel:
+    def __init__(self, link, sender, receiver, interface):
+        self.link      = link
+        self.sender    = sender    # entity transmitting on this channel
+        self.receiver  = receiver  # link layer at the other extreme
+        self.interface = interface # receiver's port (None for hosts)
+        self.sniffers  = []
+        self.occupied  = False
+        self.frame     = None
+        self.no_longer_occupied_time = None
+
+        # Frames waiting for the channel to be free, in arrival order.
+        self.queue             = collections.deque()
+        self.queued_frames     = 0 # frames that had to wait
+        self.max_queue_depth   = 0
+
+    def add_sniffer(self, sniffer):
+        self.sniffers.append(sniffer)
 
-        else: # Queue is full, so packet is lost.
-            packet = None
+    def is_occupied(self):
+        return self.occupied
+
+    def queue_depth(self):
+        return len(self.queue)
+
+    def time_to_be_free(self):
+        return self.no_longer_occupied_time
+
+    def clear(channel):
+        channel.frame    = None
+        channel.occupied = False
+        channel.no_longer_occupied_time = None
+
+    def add_frame(self, frame, event_time):
+        if self.occupied: # waits for the frames ahead of it
+            self.queue.append(frame)
+            self.queued_frames  += len(frame) if isinstance(frame, Train) else 1
+            self.max_queue_depth = max(self.max_queue_depth, len(self.queue))
             return
 
+        self.transmit(frame, event_time)
+
+    def transmit(self, frame, event_time):
+        if isinstance(frame, Train):
+            return self.transmit_train(frame, event_time)
+
+        self.occupied = True
+        self.frame    = frame
+        time          = self.link.delay + (frame.size*8 / self.link.bps)
+        self.be_sniffed(frame, event_time, frame.packet.ttl)
+
+        self.no_longer_occupied_time = time + event_time + 0.0001
+
+        def remove_frame(event):
+            free_time = self.time_to_be_free()
+            self.clear()
+            if self.queue:
+                self.send_next_frame(free_time)
+            self.deliver(frame, event.time)
+            if not self.sniffers:
+                EthernetFrame.release(frame)
+            return
+
+        return Event("message", event_time + time, remove_frame, self.sender) # reach other extreme of link
+
+    # Each frame goes in when it is ready and the one before it has left,
+    # with the timing it would have alone, but no other frame can go in
+    # between. A frame is sniffed when it goes in, with the TTL it has now
+    # (the next router may take the train before its last frames are in).
+    # The train is delivered when its first frame arrives, carrying the
+    # arrival times of all of them.
+    def transmit_train(self, train, event_time):
+        self.occupied = True
+        free = event_time
+        for k, frame in enumerate(train.items):
+            start      = max(train.times[k], free)
+            self.frame = frame
+            if self.sniffers:
+                self.sniff_at(frame, start)
+            train.times[k] = start + self.link.delay + (frame.size*8 / self.link.bps)
+            free = train.times[k] + 0.0001
+        self.no_longer_occupied_time = free
+
+        def release(event):
+            free_time = self.time_to_be_free()
+            self.clear()
+            if self.queue:
+                self.send_next_frame(free_time)
+
+        def arrive(event):
+            self.deliver(train, event.time)
+            if not self.sniffers:
+                for frame in train.items:
+                    EthernetFrame.release(frame)
+
+        Event("message", train.times[-1], release, self.sender)
+        return Event("message", train.times[0], arrive, self.sender)
+
+    def deliver(self, frame, time):
+        self.receiver.receive_from_link(frame, self.interface, time)
 
+    # Wakes only the first waiting frame. The channel stays reserved until
+    # it enters, so frames arriving meanwhile keep their place in the queue.
+    def send_next_frame(self, time):
+        self.occupied = True
+        frame = self.queue.popleft()
+
+        def insert_in_link(event):
+            self.transmit(frame, event.time)
+
+        Event("message", time, insert_in_link, self.sender)
+
+    def be_sniffed(self, frame, time, ttl):
+        for sniffer in self.sniffers:
+            sniffer.write(frame, time, ttl)
+
+    def sniff_at(self, frame, time):
+        ttl = frame.packet.ttl
+        if time <= self.sender.get_time():
+            self.be_sniffed(frame, time, ttl)
+            return
+
+        def sniff(event):
+            self.be_sniffed(frame, event.time, ttl)
+
+        Event("message", time, sniff, self.sender)
+
+
+# A full-duplex link: each direction has its own channel, so traffic in
+# one direction never waits for traffic in the other.
 class Link:
     def __init__(self, entity_list1, entity_list2, Mbps, delay):
         self.extreme1, self.port1 = self.__warn_and_get_entity(entity_list1)
         self.extreme2, self.port2 = self.__warn_and_get_entity(entity_list2)
-        self.sniffers = []
-        self.occupied = False
-        self.frame    = None
         self.bps      = float(Mbps)*(1024 * 1024)
         self.delay    = float(delay)/1000
 
+        self.channel1 = Channel(self, self.extreme1, self.extreme2.link_layer, self.port2) # 1 -> 2
+        self.channel2 = Channel(self, self.extreme2, self.extreme1.link_layer, self.port1) # 2 -> 1
+        Simulator.active.add_link(self)
+
     def add_sniffer(self, sniffer):
-        self.sniffers.append(sniffer)
+        self.channel1.add_sniffer(sniffer)
+        self.channel2.add_sniffer(sniffer)
 
     def __warn_and_get_entity(self, entity_list):
         if len(entity_list) > 1: # [router, interface]
@@ -458,34 +1348,19 @@ class Link:
             host.set_link(self)
             return (host, None)
 
+    def get_channel_from(link, sender):
+        if sender == link.extreme1:
+            return link.channel1
+        return link.channel2
+
     def is_occupied(self):
-        return self.occupied
+        return self.channel1.is_occupied() or self.channel2.is_occupied()
 
-    def clear(link):
-        link.frame    = None
-        link.occupied = False
-        link.no_longer_occupied_time = None
+    def queue_depth(self):
+        return self.channel1.queue_depth() + self.channel2.queue_depth()
 
     def add_frame(self, frame, event_time, sender):
-        self.occupied      = True
-        self.frame         = frame
-        time               = self.delay + (frame.size*8 / self.bps)
-        extreme, interface = self.get_other_extreme(sender)
-        self.be_sniffed()
-        
-        self.no_longer_occupied_time = time + event_time + 0.0001
-
-        def remove_frame(event):
-            if debug: print ("Frame id " + str(frame.id) + " saiu do link! time: " + str(event_time + time))
-            self.clear()
-            extreme.receive_from_link(frame, interface, event.time)
-            return
-        
-        event = Event("message", event_time + time, remove_frame) # reach other extreme of link
-        return
-
-    def time_to_be_free(self):
-        return self.no_longer_occupied_time
+        self.get_channel_from(sender).add_frame(frame, event_time)
 
     def get_other_extreme(link, extreme):
         if extreme == link.extreme1:
@@ -498,22 +1373,477 @@ class Link:
         else:
             return int(self.port2)
 
-    def be_sniffed(self):
-        for sniffer in self.sniffers:
-            sniffer.write(self.frame)
+# A TCP connection, named by (local port, remote ip, remote port), and the
+# data transfer over it. Messages are cut in segments of up to
+# TCPSegment.MSS bytes, sent within a window of min(congestion window,
+# receiver window) segments. The congestion window grows by slow start,
+# then by about one segment per round trip; three duplicate ACKs halve it
+# and a timeout takes it back to one segment, resending everything
+# unacknowledged (go-back-N). Segments sent together travel as a Train;
+# each is acknowledged when it arrives, and the ACKs come back as a train
+# too, each taken at its own arrival time.
+class TCPFlow:
+    INITIAL_WINDOW = 3       # segments
+    WINDOW         = 65535   # receiver window, in bytes
+    INITIAL_RTO    = 1.0     # seconds
+    MIN_RTO        = 0.2
+    MAX_RTO        = 60.0
+
+    def __init__(self, transport, ip, local_port, remote_port):
+        self.transport   = transport
+        self.host        = transport.host
+        self.ip          = ip
+        self.local_port  = local_port
+        self.remote_port = remote_port
+        self.key         = (local_port, ip, remote_port)
+        self.state       = None # "SYN SENT", "ESTABLISHED", "FIN WAIT 1", ...
+        self.sequence    = 0    # last sequence number taken
+        self.waiting     = []   # messages sent before the connection opened
+
+        # Sending: messages not yet cut in segments as [sequence number,
+        # message, data, offset of the next segment, fluid, ports], and
+        # the segments cut but not acknowledged as (sequence number, length,
+        # message, offset in the application message, last, ports), the
+        # first `sent` of them already in the network. Segments are cut
+        # only when the window reaches them.
+        self.pending       = collections.deque()
+        self.segments      = collections.deque()
+        self.sent          = 0
+        self.cwnd          = float(TCPFlow.INITIAL_WINDOW)
+        self.ssthresh      = float('inf')
+        self.duplicates    = 0
+        self.srtt          = None
+        self.rttvar        = None
+        self.rto           = TCPFlow.INITIAL_RTO
+        self.timer         = 0     # generation of the retransmission timer
+        self.timer_running = False
+        self.timing        = None  # (sequence number acknowledging it, time sent)
+        self.closing       = False # a close waits for the data
+        self.fluid         = None  # FluidFlow being sent
+        self.clock         = None  # arrival time of the ACK being taken
+        self.batch         = None  # (segments, times) let through by a train of ACKs
+
+        # Receiving: the message being reassembled.
+        self.expected  = None # next sequence number, inside a message
+        self.delivered = 0    # sequence number after the last whole message
+        self.chunks    = []
+
+    def send(self, message):
+        data     = message.extract()
+        sequence = self.sequence + 1
+
+        # Big messages go as a single entry, with no offset.
+        fluid = self.host.simulator.fluid
+        fluid = fluid is not None and len(data) >= fluid and bool(self.transport.path_to(self.ip))
+        self.pending.append([sequence, message, data, 0, fluid, self.local_port, self.remote_port])
+        # An empty message still takes a number.
+        self.sequence = sequence + (len(data) or 1) - 1
+        self.pump()
+
+    def has_data(self):
+        return bool(self.segments or self.pending)
+
+    # Cuts the next segment of the pending messages.
+    def cut(self):
+        entry = self.pending[0]
+        sequence, message, data, offset, fluid, origin_port, destination_port = entry
+        if fluid:
+            self.pending.popleft()
+            self.segments.append((sequence, len(data) or 1, message, None,
+                                  True, origin_port, destination_port))
+            return
+
+        mss    = TCPSegment.MSS or max(len(data), 1)
+        chunk  = data[offset:offset + mss]
+        length = len(chunk) or 1
+        last   = offset + mss >= len(data)
+        self.segments.append((sequence, length, Message(chunk, message.type), offset,
+                              last, origin_port, destination_port))
+        if last:
+            self.pending.popleft()
+        else:
+            entry[0] = sequence + length
+            entry[3] = offset + mss
+
+    # Sends everything the window allows, in one train.
+    def pump(self):
+        if self.fluid is not None:
+            return
+
+        window   = min(int(self.cwnd), max(TCPFlow.WINDOW // (TCPSegment.MSS or TCPFlow.WINDOW), 1))
+        segments = []
+        while self.sent < window:
+            if self.sent == len(self.segments):
+                if not self.pending:
+                    break
+                self.cut()
+            sequence, length, message, offset, last, origin_port, destination_port = self.segments[self.sent]
+            if offset is None: # a fluid flow starts once everything before it is acknowledged
+                if not self.sent and not segments:
+                    self.sent  = 1
+                    self.fluid = FluidFlow(self, self.segments[0], self.transport.path_to(self.ip))
+                    self.host.simulator.fluid_network.start(self.fluid)
+                break
+
+            segment = TCPSegment(message, "data")
+            segment.sequence_number  = sequence
+            segment.origin_port      = origin_port
+            segment.destination_port = destination_port
+            segment.PSH              = int(last)
+            segment.offset           = offset
+            segments.append(segment)
+            self.sent += 1
+
+        if segments:
+            if self.timing is None:
+                self.timing = (sequence + length, self.now())
+            if not self.timer_running:
+                self.start_timer()
+            if self.batch is not None:
+                self.batch[0].extend(segments)
+                self.batch[1].extend([self.clock] * len(segments))
+            else:
+                self.transport.send_segments(self.ip, segments)
+
+        elif not self.has_data() and self.closing:
+            self.closing = False
+            if self.clock is not None: # the FIN leaves with the ACK that let it
+                def close(event):
+                    self.transport.close_connection(self.ip, self.local_port, self.remote_port)
+
+                Event("message", self.clock, close, self.host)
+            else:
+                self.transport.close_connection(self.ip, self.local_port, self.remote_port)
+
+    # The time now, or the arrival time of the ACK being taken.
+    def now(self):
+        if self.clock is None:
+            return self.host.get_time()
+        return self.clock
+
+    # Takes the ACKs of a train, each as if at the time it arrives (all
+    # known when the first does); the segments they let through leave at
+    # those times, in one train.
+    def acknowledge_train(self, acks, times):
+        self.batch = ([], [])
+        for ack, time in zip(acks, times):
+            self.clock = time
+            self.acknowledge(ack)
+        segments, times = self.batch
+        self.clock = None
+        self.batch = None
+        if segments:
+            self.transport.send_segments(self.ip, segments, times)
+
+    def acknowledge(self, ack):
+        if self.fluid is not None: # nothing else in the network
+            return
+
+        acked = 0
+        while self.segments and self.segments[0][0] + self.segments[0][1] <= ack:
+            self.segments.popleft()
+            self.sent = max(self.sent - 1, 0)
+            acked += 1
+
+        if not acked:
+            if self.sent:
+                self.duplicates += 1
+                if self.duplicates == 3:
+                    self.retransmit(False)
+            return
+
+        self.duplicates = 0
+        if self.timing and ack >= self.timing[0]:
+            self.measure(self.now() - self.timing[1])
+            self.timing = None
 
-#TODO pensar na porta...
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked
+        else:
+            self.cwnd += float(acked) / self.cwnd
+
+        self.stop_timer()
+        if self.sent and self.segments[0][3] is not None:
+            self.start_timer()
+        self.pump()
+
+    # Round trip estimate and timeout as in RFC 6298.
+    def measure(self, rtt):
+        if self.srtt is None:
+            self.srtt   = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt   = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, TCPFlow.MIN_RTO), TCPFlow.MAX_RTO)
+
+    def retransmit(self, timeout):
+        if self.fluid is not None:
+            return
+        self.ssthresh = max(self.sent / 2, 2)
+        if timeout:
+            self.cwnd = 1.0
+            self.rto  = min(self.rto * 2, TCPFlow.MAX_RTO)
+        else:
+            self.cwnd = float(self.ssthresh)
+        self.sent       = 0
+        self.duplicates = 0
+        self.timing     = None # Karn: no samples from resent segments
+        self.stop_timer()
+        self.pump()
+
+    def start_timer(self):
+        self.timer        += 1
+        self.timer_running = True
+        timer = self.timer
+
+        def timeout(event):
+            if timer == self.timer:
+                self.timer_running = False
+                self.retransmit(True)
+
+        Event("message", self.now() + self.rto, timeout, self.host)
+
+    def stop_timer(self):
+        self.timer        += 1
+        self.timer_running = False
+
+    # Takes an arriving segment in order, returning the application message
+    # it completes, if any. Anything else is dropped, to be sent again.
+    def receive(self, segment):
+        sequence = segment.sequence_number
+        if self.expected is None:
+            if segment.offset != 0 or sequence < self.delivered:
+                return None
+            self.expected = sequence
+        if sequence != self.expected:
+            return None
+
+        append_payload(self.chunks, segment.message.extract())
+        self.expected += len(segment.message) or 1
+        if not segment.PSH:
+            return None
+
+        data = join_payload(self.chunks)
+        self.chunks    = []
+        self.delivered = self.expected
+        self.expected  = None
+        return Message(data, segment.message.type)
+
+    def ack_number(self):
+        if self.expected is None:
+            return self.delivered
+        return self.expected
+
+    def fluid_sent(self):
+        self.segments.popleft()
+        self.sent  = 0
+        self.fluid = None
+        self.pump()
+
+    def fluid_received(self, end):
+        self.delivered = max(self.delivered, end)
+        self.expected  = None
+        self.chunks    = []
+
+
+# Fluid flows #########################################################
+# In hybrid mode (Simulator(fluid = size)) TCP messages of at least that
+# many bytes are not cut in segments: they cross their path as a fluid
+# whose rate is its max-min fair share of the link capacities, capped by
+# one receiver window per round trip. Rates only change when a flow starts
+# or ends, so a transfer takes a few events whatever its size. Sniffers
+# don't see fluid flows, and packets don't wait for them.
+class FluidFlow:
+    def __init__(self, flow, entry, path):
+        self.flow = flow
+        self.sequence, self.length, self.message, offset, last, \
+            self.origin_port, self.destination_port = entry
+        self.path      = path # channels from sender to receiver
+        self.remaining = self.length * 8.0 # bits
+        self.rate      = 0.0
+        self.delay     = sum(channel.link.delay for channel in path)
+        self.limit     = float('inf')
+        if self.delay:
+            self.limit = TCPFlow.WINDOW * 8.0 / (2 * self.delay)
+
+    # The last bit reaches the receiver after the path delay, and the
+    # sender learns it one more path delay later.
+    def finish(self, time):
+        sender   = self.flow.host
+        receiver = self.path[-1].receiver.entity
+        end      = self.sequence + self.length
+
+        def deliver(event):
+            receiver.transport_layer.get_flow(sender.get_ip(), self.destination_port,
+                                              self.origin_port).fluid_received(end)
+            receiver.process(self.message, sender.get_ip(), self.origin_port, self.destination_port)
+
+            def acknowledge(event):
+                self.flow.fluid_sent()
+
+            Event("message", event.time + self.delay, acknowledge, receiver)
+
+        Event("message", time + self.delay, deliver, sender)
+
+
+class FluidNetwork:
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.flows     = []
+        self.updated   = 0.0
+        self.timer     = 0 # generation of the next completion event
+        self.started   = 0
+
+    def start(self, fluid):
+        self.advance()
+        self.flows.append(fluid)
+        self.started += 1
+        self.allocate()
+        self.schedule()
+
+    def advance(self):
+        time = self.simulator.time
+        for fluid in self.flows:
+            fluid.remaining -= fluid.rate * (time - self.updated)
+        self.updated = time
+
+    # Data bits per second a channel carries in full segments. A frame holds
+    # the channel until it reaches the other side, as in Channel.transmit.
+    @staticmethod
+    def capacity(channel):
+        link    = channel.link
+        payload = TCPSegment.MSS or TCPFlow.WINDOW
+        frame   = payload + 20 + 20 + 24 # TCP, IP and Ethernet headers
+        return payload * 8 / (link.delay + frame * 8 / link.bps + 0.0001)
+
+    # Max-min fair rates by progressive filling: the most loaded channel
+    # fixes the rate of its flows, unless some flow is capped below it.
+    def allocate(self):
+        capacity = {}
+        users    = {}
+        channels = [] # in a fixed order, so ties break the same way
+        for fluid in self.flows:
+            fluid.rate = None
+            for channel in fluid.path:
+                if not channel in capacity:
+                    capacity[channel] = FluidNetwork.capacity(channel)
+                    users[channel]    = 0
+                    channels.append(channel)
+                users[channel] += 1
+
+        pending = list(self.flows)
+        while pending:
+            share, k = min((max(capacity[channel], 0.0) / users[channel], k)
+                           for k, channel in enumerate(channels) if users[channel])
+            fixed = [fluid for fluid in pending if fluid.limit <= share]
+            if not fixed:
+                fixed = [fluid for fluid in pending if channels[k] in fluid.path]
+            for fluid in fixed:
+                fluid.rate = min(fluid.limit, share)
+                for channel in fluid.path:
+                    capacity[channel] -= fluid.rate
+                    users[channel]    -= 1
+            pending = [fluid for fluid in pending if fluid.rate is None]
+
+    def schedule(self):
+        self.timer += 1
+        if not self.flows:
+            return
+
+        timer = self.timer
+        fluid = min(self.flows, key = lambda fluid: fluid.remaining / fluid.rate)
+
+        def complete(event):
+            if timer == self.timer:
+                self.advance()
+                self.flows.remove(fluid)
+                self.allocate()
+                self.schedule()
+                fluid.finish(event.time)
+
+        Event("message", self.simulator.time + max(fluid.remaining, 0.0) / fluid.rate, complete)
+
+
+# Connections are kept in a table keyed by (local port, remote ip, remote
+# port), so a host may have any number of them with the same peer. Client
+# ports are drawn at random from PORTS, taking the next free one when the
+# drawn port is in use, and are free again once their connection is gone.
+# The side that closes first keeps the connection in TIME WAIT for
+# TIME_WAIT seconds; expired ones are dropped when a port is asked for.
 class TransportLayer:
+    PORTS     = (1024, 10000) # ephemeral ports
+    TIME_WAIT = 60.0          # seconds (2 MSL)
+
     def __init__ (self, host):
-        self.host = host
-        self.messages_to_be_send = {}
-        self.sequence_numbers    = {}
-        self.open_connections    = {}
-        self.connection_state    = {}
+        self.host        = host
+        self.connections = {}    # (local port, remote ip, remote port) -> TCPFlow
+        self.ports       = set() # ephemeral ports in use
+        self.time_wait   = collections.deque() # (expiry time, flow), in expiry order
 
 
     def get_unused_port(self):
-        return random.randint(1024, 10000)
+        self.expire()
+        low, high = TransportLayer.PORTS
+        if len(self.ports) > high - low:
+            raise RuntimeError('no free port at host ' + self.host.identifier)
+        port = self.host.random.randint(low, high)
+        while port in self.ports:
+            port = port + 1 if port < high else low
+        self.ports.add(port)
+        return port
+
+    # Gives back a port that no connection was opened from.
+    def release_port(self, port):
+        self.ports.discard(port)
+
+    def is_open(self, ip, local_port, remote_port):
+        flow = self.connections.get((local_port, ip, remote_port))
+        return flow is not None and flow.state == "ESTABLISHED"
+
+    def get_flow(self, ip, local_port, remote_port):
+        flow = self.connections.get((local_port, ip, remote_port))
+        if flow is None:
+            flow = self.new_flow(ip, local_port, remote_port, None, 0)
+        return flow
+
+    def new_flow(self, ip, local_port, remote_port, state, sequence):
+        flow = TCPFlow(self, ip, local_port, remote_port)
+        flow.state    = state
+        flow.sequence = sequence
+        self.connections[flow.key] = flow
+        return flow
+
+    def remove(self, flow):
+        if self.connections.get(flow.key) is flow:
+            del self.connections[flow.key]
+            self.ports.discard(flow.local_port)
+
+    def expire(self):
+        time = self.host.get_time()
+        while self.time_wait and self.time_wait[0][0] <= time:
+            flow = self.time_wait.popleft()[1]
+            if flow.state == "TIME WAIT":
+                self.remove(flow)
+
+    # Channels a packet to ip goes through, or None if it gets nowhere.
+    def path_to(self, ip):
+        entity  = self.host
+        channel = entity.link.get_channel_from(entity)
+        path    = []
+        for hop in range(IPPacket.TTL):
+            path.append(channel)
+            entity = channel.receiver.entity
+            if isinstance(entity, Host):
+                if entity.get_ip() == ip:
+                    return path
+                return None
+            try:
+                interface = entity.get_interface_from_table(ip)
+            except KeyError: # no route
+                return None
+            channel = entity.link_at_interface[interface].get_channel_from(entity)
+        return None
 
 
     def set_layers(self):
@@ -521,23 +1851,20 @@ class TransportLayer:
 
 
     def receive_from_network_layer(self, packet):
-        if debug: print ("Transport Layer @ " + self.host.__class__.__name__ + " " + self.host.identifier + ":"),
         segment = packet.extract_segment()
 
-        if debug: print (" ")
-        if debug: print (" ")
-        if debug: print (self.host.__class__.__name__ + " " + self.host.identifier)
-        if debug: print (" ")
-        if debug: print (" ")
-
+        if segment.kind == "data":
+            self.receive_data([packet])
+            return
 
-        if hasattr(segment, 'is_tcp_message'):
+        elif segment.kind in ("control", "ack"):
             self.respond_tcp_message(packet)
             return
         
-        elif hasattr(segment, 'is_dns_response'):
+        elif segment.kind == "DNS response":
             tokens = segment.extract_message().extract().split()
-            self.host.proceed_after_query(tokens[0], tokens[2])
+            self.host.resolver.answer(None if tokens[0] == DNSServer.UNKNOWN else tokens[0],
+                                      tokens[2])
             return
 
         else:
@@ -547,56 +1874,123 @@ class TransportLayer:
 
 
     ### TCP methods
+    # Messages sent before the handshake ends wait in the connection.
     def send_message(self, receiver, message, origin_port, destination_port):
-        if debug: print ("Transport Layer @ " + self.host.__class__.__name__ + " " + self.host.identifier),
-        if not receiver in self.open_connections: #if connection is not already open
-            self.messages_to_be_send[receiver] = message
-            self.do_three_way_handshake(receiver, origin_port, destination_port) # send message after 'second handshake'
+        flow = self.connections.get((origin_port, receiver, destination_port))
+        if flow is None or not flow.state in ("SYN SENT", "ESTABLISHED"):
+            flow = self.do_three_way_handshake(receiver, origin_port, destination_port)
+        if flow.state == "SYN SENT" or flow.waiting:
+            flow.waiting.append(message)
         else:
-            self.send_trough_open_connection(receiver, message, origin_port, destination_port)
+            flow.send(message)
         return 
-    
-    def send_trough_open_connection(self, receiver, message, origin_port, destination_port):
-        application_segment                  = TCPSegment(message)
-        application_segment.origin_port      = origin_port
-        application_segment.destination_port = destination_port
-        self.sequence_numbers[receiver]     += len(message)
-        application_segment.sequence_number  = self.sequence_numbers[receiver]
-        
-        self.network_layer.deliver_to(receiver, application_segment, "TCP")
-        return
+
+    # Segments ready at `times` go as a train; without times, more than
+    # one segment goes as a train ready now.
+    def send_segments(self, receiver, segments, times = None):
+        if len(segments) == 1 and times is None:
+            self.network_layer.deliver_to(receiver, segments[0], "TCP")
+        else:
+            self.network_layer.deliver_train(receiver, segments, "TCP", times)
+
+    # A train is taken in when its first packet arrives, knowing when the
+    # others will.
+    def receive_train(self, packets, times):
+        ip      = packets[0].sender
+        segment = packets[0].extract_segment()
+        if segment.kind == "ack":
+            flow = self.connections.get((segment.destination_port, ip, segment.origin_port))
+            if flow is not None:
+                flow.acknowledge_train([packet.extract_segment().ack_number for packet in packets],
+                                       times)
+            return
+        self.receive_data(packets, times)
+
+    # Data segments of one connection, arriving at `times` (now, if not
+    # given): each is acknowledged, and each message it completes delivered,
+    # when it arrives. The ACKs of a train go as a train.
+    def receive_data(self, packets, times = None):
+        ip       = packets[0].sender
+        segment  = packets[0].extract_segment()
+        flow     = self.get_flow(ip, segment.destination_port, segment.origin_port)
+        if flow.state == "SYN RECEIVED": # the data stands for the lost ACK
+            flow.state = "ESTABLISHED"
+        if times is None:
+            times = [self.host.get_time()] * len(packets)
+
+        responses = []
+        messages  = []
+        for packet, time in zip(packets, times):
+            segment = packet.extract_segment()
+            message = flow.receive(segment)
+            if message is not None:
+                messages.append((time, message, segment))
+
+            response = TCPSegment("", "ack")
+            response.ACK              = 1
+            response.sequence_number  = flow.sequence
+            response.ack_number       = flow.ack_number()
+            response.origin_port      = segment.destination_port
+            response.destination_port = segment.origin_port
+            responses.append(response)
+        if len(packets) == 1:
+            self.network_layer.deliver_to(ip, responses[0], "TCP")
+        else:
+            self.network_layer.deliver_train(ip, responses, "TCP", list(times))
+
+        for time, message, segment in messages:
+            self.deliver_message(time, message, ip, segment)
+
+    def deliver_message(self, time, message, ip, segment):
+        if time <= self.host.get_time():
+            self.host.process(message, ip, segment.origin_port, segment.destination_port)
+            return
+
+        def deliver(event):
+            self.host.process(message, ip, segment.origin_port, segment.destination_port)
+
+        Event("message", time, deliver, self.host)
 
     def do_three_way_handshake(self, ip, origin_port, destination_port):
         segment = TCPSegment("")
         segment.SYN = 1
         segment.sequence_number   = 1
-        segment.is_tcp_message    = 1
         segment.origin_port       = origin_port
         segment.destination_port  = destination_port
-        self.sequence_numbers[ip] = 1
+        flow = self.new_flow(ip, origin_port, destination_port, "SYN SENT", 1)
         self.network_layer.deliver_to(ip, segment, "TCP")
+        return flow
 
 
     def close_connection(self, ip, origin_port, destination_port):
-        self.messages_to_be_send.pop(ip, None)
-        self.open_connections.pop(ip, None)
-        
+        flow = self.connections.get((origin_port, ip, destination_port))
+        if flow is None or not flow.state in ("SYN RECEIVED", "ESTABLISHED"):
+            return # closed, or being closed
+        if flow.has_data(): # FIN goes after the data
+            flow.closing = True
+            return
+
         segment = TCPSegment("")
-        segment.is_tcp_message     = 1
-        self.sequence_numbers[ip] += 1
-        segment.sequence_number    = self.sequence_numbers[ip]
-        segment.origin_port        = origin_port
-        segment.destination_port   = destination_port
-        segment.FIN                = 1
-
-        self.connection_state[ip]  = "FIN WAIT 1"
+        flow.sequence            += 1
+        segment.sequence_number   = flow.sequence
+        segment.origin_port       = origin_port
+        segment.destination_port  = destination_port
+        segment.FIN               = 1
+
+        flow.state = "FIN WAIT 1"
         self.network_layer.deliver_to(ip, segment, "TCP")
 
     def respond_tcp_message(self, packet):
-        ip = packet.sender
+        ip      = packet.sender
         segment = packet.extract_segment()
+        flow    = self.connections.get((segment.destination_port, ip, segment.origin_port))
+
+        if segment.kind == "ack":
+            if flow is not None:
+                flow.acknowledge(segment.ack_number)
+            return
 
-        if TransportLayer.is_first_handshake(segment):
+        elif TransportLayer.is_first_handshake(segment):
             response = TCPSegment("")
             response.SYN = 1
             response.ACK = 1
@@ -605,90 +1999,88 @@ class TransportLayer:
             response.destination_port = segment.origin_port
 
             response.sequence_number  = 2
-            self.sequence_numbers[ip] = 2
             response.ack_number = segment.sequence_number + 1
-            response.is_tcp_message   = 1
+            self.new_flow(ip, segment.destination_port, segment.origin_port, "SYN RECEIVED", 2)
 
             self.network_layer.deliver_to(ip, response, "TCP")
             return
 
+        elif flow is None: # nothing else opens a connection
+            return
+
         elif TransportLayer.is_second_handshake(segment):
-            self.open_connections[ip] = True
+            flow.state = "ESTABLISHED"
 
             response     = TCPSegment("")
             response.ACK = 1
-            self.sequence_numbers[ip] += 1
-            response.sequence_number   = self.sequence_numbers[ip]
+            flow.sequence             += 1
+            response.sequence_number   = flow.sequence
             response.ack_number        = segment.sequence_number + 1
-            response.is_tcp_message    = 1
 
             response.origin_port      = segment.destination_port
             response.destination_port = segment.origin_port
 
             self.network_layer.deliver_to(ip, response, "TCP")
-
-            message = self.messages_to_be_send.pop(ip, "")
-            application_segment                  = TCPSegment(message)
-            self.sequence_numbers[ip]            += len(message)
-            application_segment.sequence_number  = self.sequence_numbers[ip]
-
-            application_segment.origin_port      = segment.destination_port
-            application_segment.destination_port = segment.origin_port
+            if not flow.waiting:
+                return
 
             def send(event):
-                self.network_layer.deliver_to(ip, application_segment, "TCP")
+                waiting, flow.waiting = flow.waiting, []
+                for message in waiting:
+                    flow.send(message)
 
-            Event("message", self.host.get_time() + 0.1, send)
+            Event("message", self.host.get_time() + 0.1, send, self.host)
             return
         
         elif self.is_third_handshake(segment):
-            self.open_connections[ip] = True
+            if flow.state == "SYN RECEIVED":
+                flow.state = "ESTABLISHED"
+            elif flow.state == "FIN WAIT 1": # the FIN was acknowledged
+                flow.state = "FIN WAIT 2"
+            elif flow.state == "LAST ACK":
+                flow.state = "CLOSED"
+                self.remove(flow)
             return
 
-        elif self.is_close_wait_message(segment, ip):
-            self.messages_to_be_send.pop(ip, None)
-            self.open_connections.pop(ip, None)
-
+        elif self.is_close_wait_message(segment, flow):
             new_segment = TCPSegment("")
-            new_segment.is_tcp_message     = 1
-            self.sequence_numbers[ip] += 1
-            new_segment.sequence_number    = self.sequence_numbers[ip]
+            flow.sequence                 += 1
+            new_segment.sequence_number    = flow.sequence
             new_segment.ack_number         = segment.sequence_number + 1
             new_segment.ACK                = 1
 
             new_segment.origin_port        = segment.destination_port
             new_segment.destination_port   = segment.origin_port
 
-            self.connection_state[ip]  = "CLOSE WAIT"
+            flow.state = "CLOSE WAIT"
             self.network_layer.deliver_to(ip, new_segment, "TCP")
 
             def send_fin(event):
                 new_segment = TCPSegment("")
-                new_segment.is_tcp_message     = 1
-                self.sequence_numbers[ip] += 1
-                new_segment.sequence_number    = self.sequence_numbers[ip]
+                flow.sequence                 += 1
+                new_segment.sequence_number    = flow.sequence
                 new_segment.FIN                = 1
 
                 new_segment.origin_port        = segment.destination_port
                 new_segment.destination_port   = segment.origin_port
 
-                self.connection_state[ip]  = "LAST ACK"
+                flow.state = "LAST ACK"
                 self.network_layer.deliver_to(ip, new_segment, "TCP")
 
-            Event("message", self.host.get_time() + 0.1, send_fin)
+            Event("message", self.host.get_time() + 0.1, send_fin, self.host)
 
-        elif self.is_last_ack_message(segment, ip):
+        elif self.is_last_ack_message(segment, flow):
             new_segment = TCPSegment("")
-            new_segment.is_tcp_message     = 1
-            self.sequence_numbers[ip] += 1
-            new_segment.sequence_number    = self.sequence_numbers[ip]
+            flow.sequence                 += 1
+            new_segment.sequence_number    = flow.sequence
             new_segment.ack_number         = segment.sequence_number + 1
 
             new_segment.origin_port        = segment.destination_port
             new_segment.destination_port   = segment.origin_port
             new_segment.ACK                = 1
 
-            self.connection_state[ip]  = "TIME WAIT"
+            flow.state = "TIME WAIT"
+            self.time_wait.append((self.host.get_time() + TransportLayer.TIME_WAIT, flow))
             self.network_layer.deliver_to(ip, new_segment, "TCP")
 
         return
@@ -713,16 +2105,15 @@ class TransportLayer:
         return False
 
     # closing connection methods
-    def is_close_wait_message(self, segment, sender):
-        if (segment.FIN == 1) and (not sender in self.connection_state):
+    def is_close_wait_message(self, segment, flow):
+        if (segment.FIN == 1) and flow.state in ("SYN SENT", "SYN RECEIVED", "ESTABLISHED"):
             return True
         return False
 
-    def is_last_ack_message(self, segment, sender):
+    def is_last_ack_message(self, segment, flow):
         if (segment.FIN == 1):
-            if sender in self.connection_state:
-                if self.connection_state[sender] == "FIN WAIT 1":
-                    return True
+            if flow.state in ("FIN WAIT 1", "FIN WAIT 2"):
+                return True
         return False
 
     ### UDP methods
@@ -746,28 +2137,43 @@ class NetworkLayer:
         self.dns_server      = dns_server
 
     def deliver_to(self, ip, segment, protocol):
-        if debug: print ("Network Layer @ " + self.entity.__class__.__name__ + " " + self.entity.identifier + ":"),
-        if debug: print ("segment arrived")
         ip_packet = IPPacket(segment, protocol)
         ip_packet.sender   = self.my_ip
         ip_packet.receiver = ip
 
         self.link_layer.deliver_to(ip_packet)
 
+    def deliver_train(self, ip, segments, protocol, times = None):
+        packets = []
+        for segment in segments:
+            ip_packet = IPPacket(segment, protocol)
+            ip_packet.sender   = self.my_ip
+            ip_packet.receiver = ip
+            packets.append(ip_packet)
+
+        self.link_layer.deliver_train(packets, times)
+
     def receive_from_link_layer(self, packet, interface):
-        if debug: print ("network layer @ " + self.entity.__class__.__name__ + " " + self.entity.identifier),
         if interface != None: #must hand over packet to someone
-            if debug: print ("interface " + str(interface))
             self.entity.push_packet_into_queue(interface, packet)
 
+        elif isinstance(packet, Train):
+            self.transport_layer.receive_train(packet.items, list(packet.times))
+
         else: #must give to transport layer
-            if debug: print ("")
             self.transport_layer.receive_from_network_layer(packet)
         return
 
     def repass_packet(self, packet, interface):
-        if debug: print ("network layer @ " + self.entity.__class__.__name__ + " " + self.entity.identifier),
-        if debug: print ("Repassing packet to link layer")
+        if isinstance(packet, Train):
+            for each in packet.items:
+                each.ttl -= 1
+            alive = [k for k, each in enumerate(packet.items) if each.ttl != 0]
+            if alive:
+                packet.items = [packet.items[k] for k in alive]
+                packet.times = [packet.times[k] for k in alive]
+                self.link_layer.repass_packet(packet, interface)
+            return
 
         packet.ttl -= 1
         if not packet.ttl == 0:
@@ -785,128 +2191,219 @@ class LinkLayer:
         self.link = link
 
     def deliver_to(self, packet):
-        if debug: print ("Link Layer @ " + self.entity.__class__.__name__ + " " + self.entity.identifier + ":"),
-        if debug: print ("packet arrived")
         link  = self.link
-        frame = EthernetFrame(packet)
+        frame = EthernetFrame.new(packet)
         self.put_in_link(link, frame)
 
-    def put_in_link(self, link, frame):
-        def insert_in_link(event):
-            if not (link.is_occupied()):
-                if debug: print ("Frame id " + str(frame.id) + " entrou no link. time: " + str(event.time))
-                entity = self.entity
-                link.add_frame(frame, event.time, entity)
-            else:
-                if debug: print ("Frame id " + str(frame.id) + " não entrou no link. time: " + str(link.time_to_be_free()))
-                event.reschedue(link.time_to_be_free())
+    def deliver_train(self, packets, times = None):
+        frames = [EthernetFrame.new(packet) for packet in packets]
+        if times is None:
+            times = [self.entity.get_time()] * len(frames)
+        self.put_in_link(self.link, Train(frames, times))
 
-        event = Event("message", self.entity.get_time(), insert_in_link)
+    def put_in_link(self, link, frame):
+        link.add_frame(frame, self.entity.get_time(), self.entity)
 
     def receive_from_link(self, frame, interface, time):
-        packet = frame.extract_packet()
-        if debug: print ("Link Layer @ " + self.entity.__class__.__name__ + " " + self.entity.identifier + ":"),
-        if debug: print ("frame received"),
-        if interface != None:
-            if debug: print ("@ interface: " + str(interface))
+        if isinstance(frame, Train):
+            packet = Train([each.extract_packet() for each in frame.items], frame.times)
         else:
-            if debug: print ("")
+            packet = frame.extract_packet()
         self.network_layer.receive_from_link_layer(packet, interface)
         return
 
     def repass_packet(self, packet, interface):
-        if debug: print ("Link Layer @ " + self.entity.__class__.__name__ + " " + self.entity.identifier + ":"),
-        if debug: print ("repassing packet")
         link  = self.entity.link_at_interface[interface]
-        frame = EthernetFrame(packet)
+        if isinstance(packet, Train):
+            frame = Train([EthernetFrame.new(each) for each in packet.items], packet.times)
+        else:
+            frame = EthernetFrame.new(packet)
         self.put_in_link(link, frame)
 
 
 class DNSServer(Agent):
+    UNKNOWN = 'NXDOMAIN' # answer for names of no host
+
     def __init__(self, word):
         Entity.__init__(self, word)
-        self.table = {}
-
-        for host in Entity.get_all(Host):
-            self.table[host.identifier] = host.get_ip()
 
+    # Hosts are looked up in the simulator's index of host names, which
+    # every host joins when it is created.
     def translate(self, identifier):
-        return self.table[identifier]
+        host = self.simulator.host_names.get(identifier)
+        if host is None:
+            return DNSServer.UNKNOWN
+        return host.get_ip()
 
     def receive_message(self, message, sender, origin_port, destination_port):
         response = self.translate(message.extract())
-        datagram = UDPDatagram(Message(response + " - "  + message.extract(), "DNS response"))
-        datagram.is_dns_response = True
+        datagram = UDPDatagram(Message(response + " - "  + message.extract(), "DNS response"),
+                               "DNS response")
         self.host.transport_layer.send_datagram_to(sender, datagram, destination_port, origin_port)
             
         
 class HTTPServer(Agent):
-    file_name = 'http_index.txt'
+    file_name  = 'http_index.txt' # served for a GET without a path
+    KEEP_ALIVE = 5.0 # seconds a connection is kept without requests (None: closed after each response)
 
     def __init__(self, word):
         Entity.__init__(self, word)
-        self.file = open(HTTPServer.file_name, 'r')
+        self.last_request = {} # (client ip, port) -> time of its last request, while a close is scheduled
 
     def receive_message(self, message, sender, origin_port, destination_port):
-        if message.extract() == "GET":
-            self.host.send_to(sender, Message(self.file.read(), "HTTP response"), destination_port, origin_port)
-            
-             # schedule connection close after 0.1 s.
-            def close(event):
-                self.host.close_connection(sender, destination_port, origin_port)
+        tokens = message.extract().split()
+        if tokens and tokens[0] == "GET":
+            content = self.content(tokens[1] if len(tokens) > 1 else None)
+            if content is None:
+                content = "404 Not Found"
+            self.host.send_to(sender, Message(content, "HTTP response"), destination_port, origin_port)
+
+            if HTTPServer.KEEP_ALIVE is None:
+                 # schedule connection close after 0.1 s.
+                def close(event):
+                    self.host.close_connection(sender, destination_port, origin_port)
+
+                Event("message", self.host.get_time() + 0.1, close, self.host)
+                return
 
-            Event("message", self.host.get_time() + 0.1, close)
+            # A single close is pending per connection; it is put off while
+            # requests keep coming.
+            connection = (sender, origin_port)
+            scheduled  = connection in self.last_request
+            self.last_request[connection] = self.host.get_time()
+            if scheduled:
+                return
+
+            def close_idle(event):
+                flow = self.host.transport_layer.connections.get((destination_port, sender, origin_port))
+                if flow is not None and flow.has_data(): # idle once the response is sent
+                    self.last_request[connection] = event.time
+                deadline = self.last_request[connection] + HTTPServer.KEEP_ALIVE
+                if deadline > event.time:
+                    Event("message", deadline, close_idle, self.host)
+                    return
+                del self.last_request[connection]
+                if self.host.transport_layer.is_open(sender, destination_port, origin_port):
+                    self.host.close_connection(sender, destination_port, origin_port)
+
+            Event("message", self.host.get_time() + HTTPServer.KEEP_ALIVE, close_idle, self.host)
         return
 
+# Persistent connection of an HTTP client to a server, reused by the
+# requests that follow while it is not idle for too long.
+class HTTPConnection:
+    def __init__(self, ip, port):
+        self.ip      = ip
+        self.port    = port
+        self.queued  = collections.deque() # requests not sent yet
+        self.pending = 0    # requests sent and not answered
+        self.idle    = None # time since when nothing is pending
+
+
 class HTTPClient(Agent):
+    PIPELINING   = False # send requests without waiting for the previous response
+    IDLE_TIMEOUT = 1.0   # seconds an idle connection is kept open
+    POOL_SIZE    = 6     # connections per server, as browsers do
+
     def __init__(self, word):
         Entity.__init__(self, word)
-        self.waiting_for_response = {}
+        self.connections = {} # server ip -> its HTTPConnections
+        self.completed   = 0  # responses received
 
     def do(self, time, command):
         tokens  = command.split()
-        ip      = tokens[2]
-        message = Message("GET", "HTTP command")
+        message = Message(' '.join(tokens[1:2] + tokens[3:4]), "HTTP command") # GET [path]
         port    = self.host.transport_layer.get_unused_port()
 
-        if not '.' in ip: #DNS query required.
-            self.do_DNS_query_and_send(ip, message, port, 80)
-            return
-
-        self.host.send_to(ip, message, port, 80)
+        def send(ip):
+            connection = self.choose_connection(ip, port)
+            if connection.port != port:
+                self.host.transport_layer.release_port(port)
+            connection.queued.append(message)
+            self.send_queued(connection)
+
+        self.resolve(tokens[2], port, send)
+
+    # An idle connection if there is one, else a new one while the pool
+    # has room, else the one with the fewest requests waiting. Connections
+    # the server has closed are left.
+    def choose_connection(self, ip, port):
+        transport = self.host.transport_layer
+        pool      = self.connections.setdefault(ip, [])
+        pool[:]   = [connection for connection in pool if connection.idle is None or
+                     transport.is_open(ip, connection.port, 80)]
+        for connection in pool:
+            if connection.idle is not None:
+                return connection
+        if len(pool) < HTTPClient.POOL_SIZE:
+            pool.append(HTTPConnection(ip, port))
+            return pool[-1]
+        return min(pool, key = lambda connection: connection.pending + len(connection.queued))
+
+    # A request goes when nothing is pending or, with pipelining, as soon
+    # as the connection is open.
+    def send_queued(self, connection):
+        while connection.queued and (not connection.pending or HTTPClient.PIPELINING and
+                                     self.host.transport_layer.is_open(connection.ip, connection.port, 80)):
+            connection.pending += 1
+            connection.idle     = None
+            self.host.send_to(connection.ip, connection.queued.popleft(), connection.port, 80)
 
     def receive_message(self, message, sender, origin_port, destination_port):
-        return
+        pool = self.connections.get(sender, [])
+        for connection in pool:
+            if connection.port == destination_port:
+                break
+        else:
+            return
+        if not connection.pending:
+            return
+        connection.pending -= 1
+        self.completed     += 1
+        self.send_queued(connection)
+        if connection.pending:
+            return
 
-    def do_DNS_query_and_send(self, query, message, origin_port, destination_port):
-        datagram = UDPDatagram(Message(query, "DNS query"))
-        self.waiting_for_response[query] = (message, origin_port, destination_port)
-        self.host.transport_layer.send_datagram_to(self.host.network_layer.dns_server, datagram, origin_port, 53)
+        idle = connection.idle = self.host.get_time()
+        def close(event):
+            if connection.idle == idle and connection in pool:
+                pool.remove(connection)
+                self.host.close_connection(sender, connection.port, 80)
 
-    def proceed_after_query(self, response, query):
-        message, origin_port, destination_port = self.waiting_for_response.pop(query, "")
-        self.host.send_to(response, message, origin_port, destination_port)
-        return
+        Event("message", idle + HTTPClient.IDLE_TIMEOUT, close, self.host)
 
 
 class FTPServer(Agent):
-    file_name = 'copy.txt'
+    file_name = 'copy.txt' # sent for a GET without a path
 
     def __init__(self, word):
         Entity.__init__(self, word)
-        self.file = open(FTPServer.file_name, 'r')
+        self.uploads = {} # (client ip, port) -> path of the file it is sending
 
     def receive_message(self, message, sender, origin_port, destination_port):
+        if message.type == "FTP file transfer": # the file of a PUT
+            path = self.uploads.pop((sender, origin_port), None)
+            if path is not None:
+                self.simulator.contents.put(path, message.extract())
+            self.host.send_to(sender, Message("200 OK", "FTP response"), destination_port, origin_port)
+            return
+
         tokens = message.extract().split()
         if tokens[0] == "USER":
             self.host.send_to(sender, Message("331 332 OK", "FTP response"), destination_port, origin_port)
             return
 
         elif tokens[0] == "GET":
-            self.host.send_to(sender, Message(self.file.read(), "FTP file transfer"), destination_port, origin_port)
+            content = self.content(tokens[1] if len(tokens) > 1 else None)
+            if content is None:
+                self.host.send_to(sender, Message("550 Not Found", "FTP response"), destination_port, origin_port)
+                return
+            self.host.send_to(sender, Message(content, "FTP file transfer"), destination_port, origin_port)
             return
 
         elif tokens[0] == "PUT":
+            if len(tokens) > 1:
+                self.uploads[(sender, origin_port)] = tokens[1]
             self.host.send_to(sender, Message("200 OK", "FTP response"), destination_port, origin_port)
             return
 
@@ -921,58 +2418,49 @@ class FTPClient(Agent):
 
     def __init__(self, word):
         Entity.__init__(self, word)
-        self.message_stack    = {}
-        self.file = open(FTPClient.file_name, 'r')
+        self.message_stack    = {} # (server ip, port) -> messages left, last first
+        self.completed        = 0  # sessions that got to the end
 
     def do(self, time, command):
         tokens  = command.split()    
         message = tokens[1]
-        ip      = tokens[2]
-        port    = self.host.transport_layer.get_unused_port()
+        path    = tokens[3] if len(tokens) > 3 else None
 
-        self.message_stack[ip] = [Message("QUIT", "FTP command")]
+        stack = [Message("QUIT", "FTP command")]
 
         if message == "PUT":
-            self.message_stack[ip].append(Message(self.file.read(), "FTP file transfer"))
+            content = self.content(path)
+            if content is None: # the command is left, as for an unknown host
+                print("Agente " + self.identifier + ": arquivo " + (path or FTPClient.file_name) +
+                      " inexistente")
+                return
+            stack.append(Message(content, "FTP file transfer"))
 
-        self.message_stack[ip].append(Message(message, "FTP command"))
+        port = self.host.transport_layer.get_unused_port()
 
+        stack.append(Message(' '.join(tokens[1:2] + tokens[3:4]), "FTP command"))
 
-        if not '.' in ip: #DNS query required.
-            self.do_DNS_query_and_send(ip, Message("USER FTP_USER1 PASS 1234", "FTP command"), port, 21)
-            return
+        def send(ip):
+            self.message_stack[(ip, port)] = stack
+            #Doing FTP authentication.
+            self.host.send_to(ip, Message("USER FTP_USER1 PASS 1234", "FTP command"), port, 21)
 
-        #Doing FTP authentication.
-        self.host.send_to(ip, Message("USER FTP_USER1 PASS 1234", "FTP command"), port, 21)
+        self.resolve(tokens[2], port, send)
 
     def receive_message(self, message, sender, origin_port, destination_port): 
-        if self.message_stack[sender]: #if I have another message in the stack for sender
-            new_message = self.message_stack[sender].pop()
+        stack = self.message_stack.get((sender, destination_port))
+        if stack: #if I have another message in the stack for sender
+            new_message = stack.pop()
             self.host.send_to(sender, new_message, destination_port, origin_port)
         
         else:
             #Close connection with server
-            self.message_stack.pop(sender, None)
+            if self.message_stack.pop((sender, destination_port), None) is not None:
+                self.completed += 1
             self.host.close_connection(sender, destination_port, origin_port)
             
         return
 
-    def do_DNS_query_and_send(self, query, message, origin_port, destination_port):
-        #put message in stack to be delivered later
-        self.message_stack[query].append((message, origin_port, destination_port))
-        
-        datagram = UDPDatagram(Message(query, "DNS query"))
-        self.host.transport_layer.send_datagram_to(self.host.network_layer.dns_server, datagram, origin_port, 53)
-
-    def proceed_after_query(self, response, query):
-        #Change key of message stack from query to ip
-        stack = self.message_stack.pop(query)
-        self.message_stack[response] = stack
-
-        message, origin_port, destination_port = self.message_stack[response].pop()
-        self.host.send_to(response, message, origin_port, destination_port)
-        return
-
 #define WELCOME_MSG "220 Service ready for new user.\n"
 #define ACCEPT_USER_MSG "331 User name okay, need password.\n"
 #define PROMPT_USER_PASS "332 Need account for login.\n"
@@ -980,11 +2468,94 @@ class FTPClient(Agent):
 #define INVALID_COMMAND "501 Sintax error in parameters or arguments.\n"
 #define CLOSING_MSG "221 Service closing control connection.\n"
 
+# Workload generators #################################################
+# A Generator drives the client agent it is attached to with a stream of
+# requests, started and stopped by commands of the scenario: Poisson
+# arrivals at a rate, or Poisson arrivals only during on periods that
+# alternate with off periods (both of exponential length). Each request
+# goes to one server of a list, the k-th with probability proportional to
+# 1 / k^s (Zipf; s = 0 is uniform). Only the next arrival is ever
+# scheduled, so a workload of any length takes a single event.
+#
+#   $simulator attach-agent $g0 $httpc0
+#   $simulator at 1.0 "g0 zipf 1.2"
+#   $simulator at 1.0 "g0 poisson 50 GET h2,h5,h7 /tmp/index.html"
+#   $simulator at 5.0 "g0 onoff 200 0.5 2.0 GET h2,h5,h7"
+#   $simulator at 9.0 "g0 stop"
+class Generator(Agent):
+    def __init__(self, word):
+        Entity.__init__(self, word)
+        self.random     = self.simulator.new_random(word)
+        self.exponent   = 0.0  # of the Zipf popularity of the servers
+        self.servers    = []
+        self.cumulative = []   # popularity of the servers, summed up to each
+        self.generation = 0    # of the running process; older arrivals are dropped
+        self.on_end     = None # end of the current on period
+        self.requests   = 0
+
+    # Generators are attached to an agent, and live on its host.
+    def attach_to(self, agent_name):
+        self.agent = Entity.get(agent_name)
+        self.host  = self.agent.host
+
+    def do(self, time, command):
+        tokens = command.split()
+        if tokens[1] == "zipf":
+            self.exponent = float(tokens[2])
+            self.set_servers(self.servers)
+            return
+
+        self.generation += 1
+        if tokens[1] == "stop":
+            return
+        elif tokens[1] == "poisson":
+            rate, on, off, request = float(tokens[2]), None, None, tokens[3:]
+        elif tokens[1] == "onoff":
+            rate, on, off, request = float(tokens[2]), float(tokens[3]), float(tokens[4]), tokens[5:]
+        else:
+            raise ValueError('unknown generator command ' + tokens[1])
+
+        method, path = request[0], request[2:3]
+        self.set_servers(request[1].split(','))
+        self.on_end = None
+        if on is not None:
+            self.on_end = time + self.random.expovariate(1.0 / on)
+
+        generation = self.generation
+        def arrival(event):
+            if generation != self.generation:
+                return
+            server = self.servers[bisect.bisect(self.cumulative, self.random.random() * self.cumulative[-1])]
+            self.requests += 1
+            self.agent.do(event.time, ' '.join([self.agent.identifier, method, server] + path))
+            Event("message", self.next_arrival(event.time, rate, on, off), arrival, self)
+
+        Event("message", self.next_arrival(time, rate, on, off), arrival, self)
+
+    def set_servers(self, servers):
+        self.servers    = servers
+        self.cumulative = []
+        total = 0.0
+        for k in range(len(servers)):
+            total += (k + 1) ** -self.exponent
+            self.cumulative.append(total)
+
+    # Arrivals that would fall in an off period are drawn again from the
+    # start of the next on period: the process has no memory.
+    def next_arrival(self, time, rate, on, off):
+        time += self.random.expovariate(rate)
+        while self.on_end is not None and time > self.on_end:
+            start       = self.on_end + self.random.expovariate(1.0 / off)
+            self.on_end = start + self.random.expovariate(1.0 / on)
+            time        = start + self.random.expovariate(rate)
+        return time
+
+
 class Sniffer(Entity):
     def __init__(self, word):
         Entity.__init__(self, word)
 
-    def prepare(self, entity_list, file_name):
+    def prepare(self, entity_list, file_name, file_format = 'text'):
         entity = Entity.get(entity_list[0])
         if len(entity_list) > 1: # [router, port]
             link = entity.link_at_interface[int(entity_list[1])]
@@ -993,117 +2564,777 @@ class Sniffer(Entity):
             link = entity.link
 
         link.add_sniffer(self)
-        self.file = open(file_name, 'w')
+        self.open(file_name, file_format)
+
+    def open(self, file_name, file_format):
+        if not file_format in ('text', 'pcap', 'columns'):
+            raise ValueError('unknown sniffer format ' + file_format)
+        self.file_format = file_format
+        self.writer      = self.simulator.get_sniffer_writer()
+
+        if file_format == 'columns':
+            self.file = TraceColumns(file_name)
+        elif file_format == 'pcap':
+            self.file = open(file_name, 'wb', SnifferWriter.BUFFER)
+            self.file.write(pcap_header())
+        else:
+            self.file = open(file_name, 'w', SnifferWriter.BUFFER)
+
+    def write(self, frame, time, ttl):
+        self.writer.add(self, time, frame, ttl)
+
+    def format(self, time, frame, ttl):
+        if self.file_format == 'pcap':
+            return pcap_record(time, frame, ttl)
+        if self.file_format == 'columns':
+            return trace_row(time, frame, ttl)
 
-    def write(self, frame):
         header = '------------ Pacote ' + str(frame.id) + ' ------------\n'
-        data  = header
-        data += 'Sniffer - ' + self.identifier + '\n'
-        data += 'Time    - ' + str(self.get_time()) + '\n'
-        data += (len(header)-1) * '-' + '\n\n'
-        data += str(frame)
-        data += (len(header)-1) * '.' + '\n\n'
+        rule   = len(header) - 1
+        return ''.join([header,
+                        'Sniffer - ', self.identifier, '\n',
+                        'Time    - ', str(time), '\n',
+                        rule * '-', '\n\n',
+                        frame.describe(ttl),
+                        rule * '.', '\n\n'])
+
+    def store(self, records):
+        if self.file_format == 'columns':
+            self.file.write(records)
+        elif self.file_format == 'pcap':
+            self.file.write(b''.join(records))
+        else:
+            self.file.write(''.join(records))
 
-        
-        if not shut_sniffers: print data
-        self.file.write(data)
+    def finish(self):
+        self.writer.finish()
+        self.file.close()
+
+
+# Packet capture ######################################################
+# Sniffers can write libpcap files (nanosecond timestamps, Ethernet link
+# type) with real headers built from the simulated frames. MAC addresses
+# are made up from the IP addresses, checksums other than the IP header's
+# are left as zero, and payloads are truncated at PCAP_SNAPLEN bytes.
+PCAP_SNAPLEN = 65535
+
+def pcap_header():
+    return struct.pack('<IHHiIII', 0xa1b23c4d, 2, 4, 0, 0, PCAP_SNAPLEN, 1)
+
+def mac_address(ip):
+    return b'\x02\x00' + struct.pack('!I', ip_to_int(ip))
+
+def ip_checksum(header):
+    total = sum(struct.unpack('!10H', header))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+def tcp_flags(segment):
+    return segment.FIN | (segment.SYN << 1) | (segment.PSH << 3) | (segment.ACK << 4)
+
+def pcap_record(time, frame, ttl):
+    packet  = frame.packet
+    segment = packet.transport_packet
+    payload = segment.message
+    if isinstance(payload, Message): # control segments carry a bare string
+        payload = payload.extract()
+    if isinstance(payload, Payload):
+        payload = payload[:PCAP_SNAPLEN].tobytes()
+    if not isinstance(payload, bytes):
+        payload = payload.encode('utf-8')
+
+    if packet.protocol == "TCP":
+        flags = tcp_flags(segment)
+        transport = struct.pack('!HHIIBBHHH', segment.origin_port, segment.destination_port,
+                                segment.sequence_number & 0xffffffff,
+                                segment.ack_number & 0xffffffff,
+                                5 << 4, flags, 65535, 0, 0)
+        protocol = 6
+    else:
+        transport = struct.pack('!HHHH', segment.origin_port, segment.destination_port,
+                                min(segment.size, 0xffff), 0)
+        protocol = 17
+
+    # Simulated packets may be larger than IP allows.
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, min(packet.size, 0xffff), frame.id & 0xffff,
+                     0, ttl, protocol, 0, mac_address(packet.sender)[2:],
+                     mac_address(packet.receiver)[2:])
+    ip = ip[:10] + struct.pack('!H', ip_checksum(ip)) + ip[12:]
+
+    ethernet = mac_address(packet.receiver) + mac_address(packet.sender) + b'\x08\x00'
+    data     = ethernet + ip + transport
+    data    += payload[:PCAP_SNAPLEN - len(data)]
+
+    seconds     = int(time)
+    nanoseconds = int(round((time - seconds) * 1e9))
+    if nanoseconds >= 1000000000:
+        seconds     += 1
+        nanoseconds -= 1000000000
+    return struct.pack('<IIII', seconds, nanoseconds, len(data), 14 + packet.size) + data
+
+
+# Trace columns #######################################################
+# A 'columns' sniffer keeps one fixed width row per frame, stored as a
+# directory with one file per column that grows at every written batch.
+# traces.py loads and queries them.
+TRACE_COLUMNS = [('time', 'd'), ('frame', 'I'), ('src', 'I'), ('dst', 'I'),
+                 ('sport', 'H'), ('dport', 'H'), ('protocol', 'B'), ('flags', 'B'),
+                 ('size', 'I'), ('ttl', 'B')]
+
+def trace_row(time, frame, ttl):
+    packet  = frame.packet
+    segment = packet.transport_packet
+    if packet.protocol == "TCP":
+        protocol, flags = 6, tcp_flags(segment)
+    else:
+        protocol, flags = 17, 0
+    return (time, frame.id, ip_to_int(packet.sender), ip_to_int(packet.receiver),
+            segment.origin_port, segment.destination_port, protocol, flags,
+            frame.size, ttl)
+
+class TraceColumns:
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # The layout, so the files can be read on any machine.
+        f = open(os.path.join(directory, 'columns'), 'w')
+        f.write(sys.byteorder + '\n')
+        for name, typecode in TRACE_COLUMNS:
+            f.write(name + ' ' + typecode + ' ' + str(array.array(typecode).itemsize) + '\n')
+        f.close()
+
+        self.files = [open(os.path.join(directory, name), 'wb', SnifferWriter.BUFFER)
+                      for name, typecode in TRACE_COLUMNS]
+
+    def write(self, rows):
+        columns = zip(*rows)
+        for f, (name, typecode), values in zip(self.files, TRACE_COLUMNS, columns):
+            array.array(typecode, values).tofile(f)
+
+    def flush(self):
+        for f in self.files:
+            f.flush()
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+
+# Formats and writes the records of every sniffer of a simulation in a
+# background thread, so capturing a frame only appends it to a batch.
+# Batches go through a bounded queue: if the disk can't keep up, the
+# simulation waits instead of piling records up in memory.
+class SnifferWriter(threading.Thread):
+    BATCH   = 1024    # records per batch
+    BATCHES = 64      # batches waiting to be written
+    BUFFER  = 1 << 20 # bytes of file buffer
+
+    def __init__(self, echo):
+        threading.Thread.__init__(self)
+        self.daemon  = True
+        self.echo    = echo
+        self.batch   = []
+        self.batches = queue.Queue(SnifferWriter.BATCHES)
+        self.error   = None
+        self.done    = False
+        self.files   = set()
+        self.start()
+
+    def add(self, sniffer, time, frame, ttl):
+        self.batch.append((sniffer, time, frame, ttl))
+        if len(self.batch) >= SnifferWriter.BATCH:
+            self.send_batch()
+
+    def send_batch(self):
+        if self.error:
+            raise self.error
+        self.batches.put(self.batch)
+        self.batch = []
+
+    def run(self):
+        while True:
+            batch = self.batches.get()
+            try:
+                if batch is None:
+                    return
+                if not self.error:
+                    self.write(batch)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.batches.task_done()
+
+    def write(self, batch):
+        data = {} # sniffer -> records
+        for sniffer, time, frame, ttl in batch:
+            record = sniffer.format(time, frame, ttl)
+            data.setdefault(sniffer, []).append(record)
+            if self.echo and sniffer.file_format == 'text':
+                sys.stdout.write(record + '\n')
+        for sniffer, records in data.items():
+            sniffer.store(records)
+            self.files.add(sniffer.file)
+
+    # Waits until everything captured so far is on the files.
+    def flush(self):
+        if self.done:
+            return
+        self.send_batch()
+        self.batches.join()
+        if self.error:
+            raise self.error
+        for f in self.files:
+            f.flush()
 
     def finish(self):
+        if self.done:
+            return
+        self.flush()
+        self.done = True
+        self.batches.put(None)
+        self.join()
+
+
+# Profiling ##########################################################
+# With Simulator(profile = True) the run loop also measures the wall time
+# of every event, grouped by handler: the function the event runs (named
+# with its line, as most are closures) or, for the commands of the
+# scenario, the agent class and command. The report is printed when the
+# run ends; to_dict() has the same numbers for JSON.
+class Profiler:
+    def __init__(self):
+        self.handlers   = {} # handler -> [events, seconds]
+        self.names      = {} # code of a handler -> its name
+        self.events     = 0
+        self.wall_time  = 0.0
+        self.peak_queue = 0  # most pending events
+        self.simulated  = 0.0
+
+    def run(self, simulator):
+        events   = simulator.events
+        handlers = self.handlers
+        clock    = timeit.default_timer
+        started  = clock()
+        while not events.empty():
+            event = events.get_next()
+            start = clock()
+            event.process()
+            elapsed = clock() - start
+
+            name  = self.name(event)
+            entry = handlers.get(name)
+            if entry is None:
+                entry = handlers[name] = [0, 0.0]
+            entry[0] += 1
+            entry[1] += elapsed
+            simulator.processed_events += 1
+            pending = len(events.scheduler)
+            if pending > self.peak_queue:
+                self.peak_queue = pending
+
+        self.wall_time += clock() - started
+        self.events     = sum(entry[0] for entry in handlers.values())
+        self.simulated  = simulator.time
+
+    def name(self, event):
+        if event.event_type == "order":
+            tokens = event.command.split()
+            if tokens[0] == "finish":
+                return "finish"
+            return event.entity.__class__.__name__ + ' ' + tokens[1]
+
+        command = event.command
+        code    = getattr(command, '__code__', None)
+        name    = self.names.get(code)
+        if name is None:
+            name = getattr(command, '__name__', command.__class__.__name__)
+            if code is not None:
+                name += ' (' + os.path.basename(code.co_filename) + ':' + str(code.co_firstlineno) + ')'
+            self.names[code] = name
+        return name
+
+    def to_dict(self):
+        wall = self.wall_time or float('nan')
+        return {
+            'events'            : self.events,
+            'wall_time'         : self.wall_time,
+            'events_per_second' : self.events / wall,
+            'simulated_time'    : self.simulated,
+            'time_ratio'        : self.simulated / wall, # simulated seconds per wall second
+            'peak_event_queue'  : self.peak_queue,
+            'handlers'          : dict((name, {'events' : events, 'seconds' : seconds})
+                                       for name, (events, seconds) in self.handlers.items()),
+        }
+
+    def report(self, simulator):
+        profile = self.to_dict()
+        print ("+-----------------+")
+        print ("|      Perfil     |")
+        print ("+-----------------+")
+        print ("Eventos: %d em %.3f s (%.0f eventos/s)" %
+               (profile['events'], profile['wall_time'], profile['events_per_second']))
+        print ("Tempo simulado: %.6f s (%.3f s simulados por segundo)" %
+               (profile['simulated_time'], profile['time_ratio']))
+        print ("Maior fila de eventos: %d" % profile['peak_event_queue'])
+        print ("")
+        print ("%10s %10s %6s %12s  %s" % ('eventos', 'tempo (s)', '%', 'us/evento', 'tratador'))
+        total = sum(seconds for events, seconds in self.handlers.values()) or float('nan')
+        for name, (events, seconds) in sorted(self.handlers.items(), key = lambda item: -item[1][1]):
+            print ("%10d %10.4f %6.1f %12.2f  %s" %
+                   (events, seconds, 100 * seconds / total, 1e6 * seconds / events, name))
+
+
+# Tracing #############################################################
+# Trace points are layer methods whose calls can be watched. Each simulator
+# has its own tracer, which keeps its subscriptions. While some simulator
+# subscribes to a point, its method is wrapped on the class, so that every
+# call made by the running simulator first hands a record (a dict with the
+# point name, the simulated time, the entity and the fields of the call) to
+# that simulator's subscribers; a point nobody listens to is the plain
+# method again, and costs nothing. Subscribers are callables, set up before
+# running:
+#
+#   s    = simulator.Simulator()
+#   ring = simulator.RingBuffer(10000)
+#   s.tracer.subscribe('router.*', ring)
+#   s.tracer.subscribe('*', simulator.JSONLines('/tmp/flow.jsonl'),
+#                      where = {'src': '192.168.1.2', 'dport': 80})
+trace_points    = collections.OrderedDict() # name -> (class, method, fields, original)
+trace_listeners = {} # name -> subscriptions of all simulators
+
+def trace_point(name, owner, method, fields):
+    trace_points[name]    = (owner, method, fields, owner.__dict__[method])
+    trace_listeners[name] = 0
+
+def bind_trace_point(name):
+    owner, method, fields, original = trace_points[name]
+    if not trace_listeners[name]:
+        setattr(owner, method, original)
+        return
+
+    def traced(self, *args):
+        simulator   = Simulator.active
+        subscribers = simulator and simulator.tracer.subscribers.get(name)
+        if subscribers:
+            record = fields(self, *args)
+            record['point'] = name
+            record.setdefault('time', simulator.time)
+            for subscriber, where in subscribers:
+                if where is None or all(record.get(key) == value for key, value in where.items()):
+                    subscriber(record)
+        return original(self, *args)
+
+    setattr(owner, method, traced)
+
+
+class Tracer:
+    def __init__(self):
+        self.subscribers = {} # name -> [(subscriber, where)]
+
+    # Points matching the patterns ('*', 'link.*', 'router.drop,tcp.*').
+    def match(self, patterns):
+        if isinstance(patterns, str):
+            patterns = patterns.split(',')
+        return [name for name in trace_points
+                    if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)]
+
+    # Records are only handed over if their fields have the values in
+    # `where`, to follow a single flow or entity.
+    def subscribe(self, patterns, subscriber, where = None):
+        names = self.match(patterns)
+        if not names:
+            raise ValueError('no trace point matches ' + str(patterns) + ' (points: ' +
+                             ', '.join(trace_points) + ')')
+        for name in names:
+            self.subscribers.setdefault(name, []).append((subscriber, where))
+            trace_listeners[name] += 1
+            bind_trace_point(name)
+
+    # Subscribers are compared by equality: each self.records.append is a
+    # new bound method.
+    def unsubscribe(self, subscriber):
+        for name, subscribers in list(self.subscribers.items()):
+            kept = [entry for entry in subscribers if entry[0] != subscriber]
+            if len(kept) == len(subscribers):
+                continue
+            trace_listeners[name] -= len(subscribers) - len(kept)
+            if kept:
+                self.subscribers[name] = kept
+            else:
+                del self.subscribers[name]
+            bind_trace_point(name)
+
+
+# Subscribers.
+class JSONLines:
+    def __init__(self, file_name):
+        self.file = open(file_name, 'w', SnifferWriter.BUFFER)
+
+    # Values JSON has no numbers for (the ssthresh of a flow still in slow
+    # start is infinite) are written as null.
+    def __call__(self, record):
+        record = dict((key, None if isinstance(value, float) and
+                             (math.isinf(value) or math.isnan(value)) else value)
+                      for key, value in record.items())
+        self.file.write(json.dumps(record, sort_keys = True, allow_nan = False) + '\n')
+
+    def close(self):
         self.file.close()
 
 
+# Keeps the last `size` records.
+class RingBuffer:
+    def __init__(self, size):
+        self.buffer = collections.deque(maxlen = size)
+
+    def __call__(self, record):
+        self.buffer.append(record)
+
+    def records(self):
+        return list(self.buffer)
+
+
+def print_record(record):
+    fields = ' '.join(key + '=' + str(record[key]) for key in sorted(record)
+                      if not key in ('time', 'point', 'entity'))
+    print ('%.6f %-18s %-8s %s' % (record['time'], record['point'], record.get('entity'), fields))
+
+try:
+    read_line = raw_input
+except NameError: # Python 3
+    read_line = input
+
+def pause(record):
+    read_line()
+
+def print_stack(record):
+    traceback.print_stack(file=sys.stdout)
+
+
+# Trace points.
+def packet_fields(entity, packet, **fields):
+    count = 1
+    if isinstance(packet, Train):
+        count, packet = len(packet), packet.items[0]
+    if isinstance(packet, EthernetFrame):
+        fields['frame'] = packet.id
+        packet = packet.packet
+    segment = packet.transport_packet
+    fields.update(entity = entity.identifier, src = packet.sender, dst = packet.receiver,
+                  proto = packet.protocol, sport = segment.origin_port,
+                  dport = segment.destination_port, kind = segment.kind,
+                  size = packet.size, ttl = packet.ttl, count = count)
+    if packet.protocol == "TCP":
+        fields['seq'] = segment.sequence_number
+    return fields
+
+def flow_fields(flow, **fields):
+    fields.update(entity = flow.host.identifier, dst = flow.ip, sport = flow.local_port,
+                  dport = flow.remote_port, cwnd = flow.cwnd,
+                  ssthresh = flow.ssthresh, in_flight = flow.sent, rto = flow.rto)
+    return fields
+
+def segment_fields(layer, ip, segment, count = 1):
+    return {'entity' : layer.entity.identifier,
+            'dst'    : ip,
+            'sport'  : segment.origin_port,
+            'dport'  : segment.destination_port,
+            'kind'   : segment.kind,
+            'size'   : segment.size,
+            'count'  : count}
+
+trace_point('event', Event, 'process',
+    lambda event: {'entity' : event.creator and event.creator.identifier,
+                   'type'   : event.event_type, 'time' : event.time})
+trace_point('transport.send', TransportLayer, 'send_message',
+    lambda layer, ip, message, origin_port, destination_port:
+        {'entity' : layer.host.identifier, 'dst' : ip, 'sport' : origin_port,
+         'dport' : destination_port, 'type' : message.type, 'size' : len(message)})
+trace_point('transport.receive', TransportLayer, 'receive_from_network_layer',
+    lambda layer, packet: packet_fields(layer.host, packet))
+trace_point('transport.receive_train', TransportLayer, 'receive_train',
+    lambda layer, packets, times: dict(packet_fields(layer.host, packets[0]), count = len(packets)))
+trace_point('tcp.ack', TCPFlow, 'acknowledge',
+    lambda flow, ack: flow_fields(flow, ack = ack))
+trace_point('tcp.retransmit', TCPFlow, 'retransmit',
+    lambda flow, timeout: flow_fields(flow, timeout = timeout))
+trace_point('network.send', NetworkLayer, 'deliver_to',
+    lambda layer, ip, segment, protocol: segment_fields(layer, ip, segment))
+trace_point('network.send_train', NetworkLayer, 'deliver_train',
+    lambda layer, ip, segments, protocol, times = None:
+        segment_fields(layer, ip, segments[0], len(segments)))
+trace_point('network.receive', NetworkLayer, 'receive_from_link_layer',
+    lambda layer, packet, interface: packet_fields(layer.entity, packet, interface = interface))
+trace_point('network.forward', NetworkLayer, 'repass_packet',
+    lambda layer, packet, interface: packet_fields(layer.entity, packet, interface = interface))
+trace_point('router.enqueue', Router, 'push_packet_into_queue',
+    lambda router, interface, packet: packet_fields(router, packet, interface = interface,
+                                                    queue = len(router.packet_queue[interface])))
+trace_point('router.drop', Router, 'drop_packet',
+    lambda router, interface, packet, count: packet_fields(router, packet, interface = interface,
+                                                           dropped = count))
+trace_point('link.send', LinkLayer, 'put_in_link',
+    lambda layer, link, frame: packet_fields(layer.entity, frame))
+trace_point('link.receive', LinkLayer, 'receive_from_link',
+    lambda layer, frame, interface, time: packet_fields(layer.entity, frame, interface = interface))
+trace_point('channel.add', Channel, 'add_frame',
+    lambda channel, frame, time: packet_fields(channel.sender, frame, waits = channel.occupied,
+                                              to = channel.receiver.entity.identifier))
+trace_point('channel.transmit', Channel, 'transmit',
+    lambda channel, frame, time: packet_fields(channel.sender, frame,
+                                              to = channel.receiver.entity.identifier))
+trace_point('channel.deliver', Channel, 'deliver',
+    lambda channel, frame, time: packet_fields(channel.sender, frame,
+                                              to = channel.receiver.entity.identifier))
+
+
 # Reads the entry and updates the system #############################
+# The entry is compiled, in a single pass, into a list of operations whose
+# arguments are already converted (numbers, route prefixes, link ends);
+# loading runs them in order. With a cache directory, the operations are
+# kept in a binary file named after the hash of the entry, and the next
+# loads of the same entry run them without parsing it again.
+
+CACHE_VERSION = '1' # changes whenever the operations do
+
+# Classes of the 'new Agent/...' lines.
+agent_classes = dict((cls.__name__, cls) for cls in
+                     (DNSServer, HTTPServer, HTTPClient, FTPServer, FTPClient, Generator,
+                      Sniffer))
+
+# A token is a quoted string, a bracketed expression or a word ('$' is
+# dropped from words). Most lines have only words.
+TOKEN = re.compile(r'"([^"]*)"|\[([^\]]*)\]|(\S+)')
+
+def tokenize(line):
+    if not '"' in line and not '[' in line:
+        return line.replace('$', '').split()
+    return [match.group(3).lstrip('$') if match.lastindex == 3 else match.group(match.lastindex)
+            for match in TOKEN.finditer(line)]
+
+# "r0.2" -> ('r0', 2), "h0" -> ('h0',)
+def link_end(word):
+    parts = word.split('.')
+    if len(parts) > 1:
+        return (parts[0], int(parts[1]))
+    return (parts[0],)
+
 class Reader:
-    def __init__(self, file_name):
-        f = open(file_name)
-        self.lines_counter = sum(1 for line in f)
+    def __init__(self, file_name, cache = None):
+        self.file_name = file_name
+        self.cache     = cache
+
+    def read_entry(self, operations = None):
+        if operations is None:
+            operations = self.operations()
+        for operation in operations:
+            Reader.runners[operation[0]](self, *operation[1:])
+
+    def operations(self):
+        f = open(self.file_name)
+        entry = f.read()
         f.close()
-        self.file = open(file_name, 'r')
-
-    def read_entry(self):
-        while self.lines_counter > 0:
-            line = self.get_line()
-            if line.startswith('set '):
-                self.instantiate(line)
-            elif line.startswith('$simulator '):
-                self.update_entities(line)
-
-    def get_line(self):
-        line = self.file.readline()
-        self.lines_counter -= 1
-        while '\\' in line:
-            line = line.strip().replace('\\', ' ')
-            append_line = self.file.readline()
-            self.lines_counter -= 1
-            line += append_line
-        return line.strip()
-
-    def instantiate(self, line):
-        tokens = line.split()
-        if '[$simulator host]' in line:
-            Host(tokens[1])
-        elif '[$simulator router ' in line:
-            interfaces = tokens[4].replace(']', '')
-            Router(tokens[1], interfaces)
-        elif '[new Agent/' in line:
-            # gets class name
-            beginning = line.find('[new Agent/') + len('[new Agent/')
-            end = line.find(']', beginning)
-            agent = line[beginning:end]
-            # instantiates object given its class name
-            globals()[agent](tokens[1])
-
-    def update_entities(self, line):
-        tokens = line.replace('$', '').split()
-        if ' performance ' in line:
-            router = Entity.get(tokens[1])
-            router.set_delay(tokens[3][:len(tokens[3]) - 2])
-            for k in range(4, len(tokens), 2):
-                router.set_limit(tokens[k], tokens[k + 1])
-
-        elif '$simulator duplex-link ' in line:
-            Mbps = tokens[4][:len(tokens[4]) - 4]
-            delay = tokens[5][:len(tokens[5]) - 2]
-            Link(tokens[2].split('.'), tokens[3].split('.'), Mbps, delay)
-
-        elif '$simulator attach-agent ' in line:
-            if len(tokens) > 4:
-                sniffer = Entity.get(tokens[2])
-                sniffer.prepare(tokens[3].split('.'),
-                            tokens[5].replace('"', ''))
-            else:
-                Entity.get(tokens[2]).attach_to(tokens[3])
+        if self.cache is None:
+            return self.compile(entry)
+
+        key = CACHE_VERSION + entry
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        path = os.path.join(self.cache, hashlib.sha1(key).hexdigest() + '.scenario')
+        if os.path.exists(path):
+            f = open(path, 'rb')
+            try:
+                return marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                pass # unreadable, compiled again below
+            finally:
+                f.close()
+
+        operations = self.compile(entry)
+        if not os.path.isdir(self.cache):
+            os.makedirs(self.cache)
+        # Written aside and renamed, so concurrent loads never see half a file.
+        temporary = path + '.' + str(os.getpid())
+        f = open(temporary, 'wb')
+        marshal.dump(operations, f)
+        f.close()
+        os.rename(temporary, path)
+        return operations
+
+    def compile(self, entry):
+        operations = []
+        line = ''
+        for physical_line in entry.splitlines():
+            line += physical_line.strip()
+            if line.endswith('\\'):
+                line = line[:-1] + ' '
+                continue
+            tokens = tokenize(line)
+            line   = ''
+            if len(tokens) < 2:
+                continue
+            if tokens[0] == 'set':
+                operations.append(self.compile_set(tokens))
+            elif tokens[0] == 'simulator':
+                compiler = Reader.compilers.get(tokens[1], Reader.compile_entity)
+                operations.append(compiler(self, tokens))
+        return operations
+
+    # Compilers, from the tokens of a line to an operation ##############
+
+    def compile_set(self, tokens):
+        words = tokens[2].split()
+        if words == ['$simulator', 'host']:
+            return ('host', tokens[1])
+        elif words[:2] == ['$simulator', 'router']:
+            return ('router', tokens[1], int(words[2]))
+        elif words[0] == 'new' and words[1].startswith('Agent/'):
+            class_name = words[1][len('Agent/'):]
+            if not class_name in agent_classes:
+                raise ValueError('unknown agent ' + class_name)
+            return ('agent', class_name, tokens[1])
+        raise ValueError('unknown entity ' + tokens[2])
+
+    def compile_link(self, tokens):
+        return ('link', link_end(tokens[2]), link_end(tokens[3]),
+                float(tokens[4][:-len('Mbps')]), float(tokens[5][:-len('ms')]))
+
+    def compile_attach(self, tokens):
+        if len(tokens) > 4:
+            file_format = tokens[6] if len(tokens) > 6 else 'text'
+            return ('sniffer', tokens[2], link_end(tokens[3]), tokens[5], file_format)
+        return ('attach', tokens[2], tokens[3])
+
+    def compile_at(self, tokens):
+        return ('at', float(tokens[2]), ' '.join(tokens[3:]))
+
+    def compile_entity(self, tokens):
+        if tokens[2] == 'performance':
+            return ('performance', tokens[1], float(tokens[3][:-len('us')]),
+                    [(int(tokens[k]), int(tokens[k + 1])) for k in range(4, len(tokens), 2)])
+        elif tokens[2] == 'route':
+            return ('route', tokens[1], [(parse_prefix(tokens[k]), tokens[k + 1])
+                                         for k in range(3, len(tokens), 2)])
+        elif len(tokens) == 5:
+            return ('host_ips', tokens[1], tokens[2], tokens[3], tokens[4])
+        return ('router_ips', tokens[1], [(int(tokens[k]), tokens[k + 1])
+                                          for k in range(2, len(tokens), 2)])
 
-        elif ' route ' in line:
-            router = Entity.get(tokens[1])
-            for k in range(3, len(tokens), 2):
-                router.update_table(tokens[k], tokens[k + 1])
+    compilers = {'duplex-link' : compile_link, 'attach-agent' : compile_attach, 'at' : compile_at}
 
-        elif '$simulator at ' in line:
-            tokens = line.split(' ', 3)
-            Event("order", tokens[2], tokens[3].replace('"', ''))
+    # Runners, one per kind of operation ################################
 
-        elif len(tokens) == 5:
-            host = Entity.get(tokens[1])
-            host.set_ips(tokens[2], tokens[3], tokens[4])
+    def run_host(self, name):
+        Host(name)
 
-        else:
-            router = Entity.get(tokens[1])
-            for k in range(2, len(tokens), 2):
-                router.set_ip_at(tokens[k], tokens[k + 1])
+    def run_router(self, name, interfaces):
+        Router(name, interfaces)
 
+    def run_agent(self, class_name, name):
+        Simulator.active.create_agent(class_name, name)
 
-    def destroy(self):
-        self.file.close()
+    def run_link(self, end1, end2, Mbps, delay):
+        Link(end1, end2, Mbps, delay)
+
+    def run_sniffer(self, name, end, file_name, file_format):
+        Entity.get(name).prepare(end, file_name, file_format)
+
+    def run_attach(self, name, host_name):
+        Entity.get(name).attach_to(host_name)
+
+    def run_at(self, time, command):
+        Event("order", time, command)
+
+    def run_performance(self, name, delay, limits):
+        router = Entity.get(name)
+        router.set_delay(delay)
+        for interface, limit in limits:
+            router.set_limit(interface, limit)
+
+    def run_route(self, name, routes):
+        router = Entity.get(name)
+        for prefix, destination in routes:
+            router.add_route(prefix, destination)
+
+    def run_host_ips(self, name, ip, standard_router, dns_server):
+        Entity.get(name).set_ips(ip, standard_router, dns_server)
+
+    def run_router_ips(self, name, ips):
+        router = Entity.get(name)
+        for interface, ip in ips:
+            router.set_ip_at(interface, ip)
+
+    runners = {'host' : run_host, 'router' : run_router, 'agent' : run_agent,
+               'link' : run_link, 'sniffer' : run_sniffer, 'attach' : run_attach,
+               'at' : run_at, 'performance' : run_performance, 'route' : run_route,
+               'host_ips' : run_host_ips, 'router_ips' : run_router_ips}
 
 
 # Main program #######################################################
 
-if len(sys.argv) != 2:
-    print 'Usage: python simulator.py file_name'
-    exit(-1)
+def main(argv = None):
+    parser = argparse.ArgumentParser(usage = 'python simulator.py [options] file_name')
+    parser.add_argument('file_name')
+    parser.add_argument('--scheduler', choices = sorted(schedulers), default = 'heap',
+                        help = 'event queue implementation (default: heap)')
+    parser.add_argument('--seed', type = int,
+                        help = 'seed for the random choices of the simulation')
+    parser.add_argument('--echo-sniffers', action = 'store_true',
+                        help = 'also print sniffer logs on stdout')
+    parser.add_argument('--fluid', type = int, metavar = 'BYTES',
+                        help = 'model TCP messages of at least BYTES bytes as fluid flows')
+    parser.add_argument('--content-cache', type = int, metavar = 'MB',
+                        help = 'most megabytes of served files kept mapped (default: 256)')
+    parser.add_argument('--profile', action = 'store_true',
+                        help = 'print the wall time spent by each event handler when the run ends')
+    parser.add_argument('--profile-json', metavar = 'FILE',
+                        help = 'also write the profile to FILE as JSON (implies --profile)')
+    parser.add_argument('--routing', choices = ['delay', 'bandwidth'],
+                        help = 'route to every host along the shortest path by this link '
+                               'metric; route lines are only used for other addresses')
+    parser.add_argument('--cache', metavar = 'DIR',
+                        help = 'keep the compiled entry in DIR, and load it from there '
+                               'while the file is unchanged')
+    parser.add_argument('--trace', metavar = 'POINTS',
+                        help = 'write the records of these trace points as JSON lines '
+                               '(comma separated, * for any part; e.g. router.*,tcp.ack)')
+    parser.add_argument('--trace-file', default = 'trace.jsonl',
+                        help = 'file of the --trace records (default: trace.jsonl)')
+    args = parser.parse_args(argv)
+
+    global echo_sniffers
+    echo_sniffers = args.echo_sniffers
+
+    simulator = Simulator(args.scheduler, args.seed, args.fluid,
+                          args.profile or args.profile_json is not None, args.routing)
+    tracer    = simulator.tracer
+    if debug:
+        tracer.subscribe('*', print_record)
+    if event_pause:
+        tracer.subscribe('event', pause)
+    if stack_print:
+        tracer.subscribe('event', print_stack)
+    trace = None
+    if args.trace:
+        if not tracer.match(args.trace):
+            parser.error('no trace point matches ' + args.trace + ' (points: ' +
+                         ', '.join(trace_points) + ')')
+        trace = JSONLines(args.trace_file)
+        tracer.subscribe(args.trace, trace)
+
+    if args.content_cache is not None:
+        simulator.contents.capacity = args.content_cache << 20
+    simulator.load(args.file_name, args.cache)
+    simulator.run()
+    if args.profile_json:
+        f = open(args.profile_json, 'w')
+        json.dump(simulator.profiler.to_dict(), f, indent = 1, sort_keys = True)
+        f.close()
+    if trace:
+        trace.close()
+
 
-r = Reader(sys.argv[1])
-r.read_entry()
-r.destroy()
-Simulator.start()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Runs every combination of a parameter grid over a base scenario in a
+# process pool and prints one line of metrics per run.
+#
+#   python sweep.py entry.txt -p Mbps=2,5,10 -p queue_limit:r0=10,100 \
+#                             -p at_scale=0.5,1 --repeat 3 --seed 7
+
+import os
+import sys
+import time
+import argparse
+import itertools
+import multiprocessing
+
+import simulator
+
+# name -> kind of scenario line it changes
+PARAMETERS = {
+    'Mbps'         : 'duplex-link', # link bandwidth, in Mbps
+    'delay'        : 'duplex-link', # link delay, in ms
+    'router_delay' : 'performance', # router processing time, in us
+    'queue_limit'  : 'performance', # packets per router interface queue
+    'at_scale'     : 'at',          # factor applied to every 'at' time
+}
+
+METRICS = ['time', 'events', 'frames', 'queued_frames', 'max_link_queue',
+           'forwarded_packets', 'dropped_packets', 'max_router_queue', 'fluid_flows',
+           'wall_time', 'error']
+
+
+# Parses '-p name[:entity]=v1,v2,...' options.
+def parse_parameter(option):
+    name, values = option.split('=', 1)
+    entity = None
+    if ':' in name:
+        name, entity = name.split(':', 1)
+    if not name in PARAMETERS:
+        raise ValueError('unknown parameter ' + name + ' (expected one of ' +
+                         ', '.join(sorted(PARAMETERS)) + ')')
+    return (name, entity), values.split(',')
+
+
+def expand_grid(parameters):
+    keys = [key for key, values in parameters]
+    for values in itertools.product(*[values for key, values in parameters]):
+        yield dict(zip(keys, values))
+
+
+def mentions(ends, entity):
+    return entity is None or entity in [end[0] for end in ends]
+
+
+# The entry is compiled once by simulator.Reader; each variant changes the
+# arguments of its operations.
+def apply_variant(operations, variant, sniffer_dir):
+    result = []
+    for operation in operations:
+        kind = operation[0]
+
+        if kind == 'link':
+            kind, end1, end2, Mbps, delay = operation
+            for (name, entity), value in variant.items():
+                if PARAMETERS[name] == 'duplex-link' and mentions([end1, end2], entity):
+                    if name == 'Mbps':
+                        Mbps = float(value)
+                    else:
+                        delay = float(value)
+            operation = (kind, end1, end2, Mbps, delay)
+
+        elif kind == 'performance':
+            kind, router, delay, limits = operation
+            for (name, entity), value in variant.items():
+                if PARAMETERS[name] == 'performance' and mentions([(router,)], entity):
+                    if name == 'router_delay':
+                        delay = float(value)
+                    else:
+                        limits = [(interface, int(value)) for interface, limit in limits]
+            operation = (kind, router, delay, limits)
+
+        elif kind == 'at':
+            kind, time, command = operation
+            for (name, entity), value in variant.items():
+                if name == 'at_scale' and command != 'finish':
+                    time *= float(value)
+            operation = (kind, time, command)
+
+        elif kind == 'sniffer':
+            # Concurrent runs must not share sniffer files.
+            kind, sniffer, end, path, file_format = operation
+            if sniffer_dir is None:
+                path, file_format = os.devnull, 'text'
+            else:
+                path = os.path.join(sniffer_dir, os.path.basename(path))
+            operation = (kind, sniffer, end, path, file_format)
+
+        result.append(operation)
+    return result
+
+
+def run_variant(job):
+    run, seed, variant, operations, scheduler, fluid, sniffer_dir = job
+    if sniffer_dir is not None:
+        sniffer_dir = os.path.join(sniffer_dir, 'run-' + str(run))
+        if not os.path.isdir(sniffer_dir):
+            os.makedirs(sniffer_dir)
+
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    start = time.time()
+    s = simulator.Simulator(scheduler, seed, fluid)
+    try:
+        # A variant that crashes is reported, the others still run.
+        try:
+            s.load(None, operations = apply_variant(operations, variant, sniffer_dir))
+            s.run()
+            error = '-'
+        except Exception as e:
+            error = e.__class__.__name__ + ': ' + str(e)
+        metrics = s.summary()
+        metrics['wall_time'] = time.time() - start
+        metrics['error']     = error
+        s.reset()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    return run, seed, variant, metrics
+
+
+def format_key(key):
+    name, entity = key
+    if entity is None:
+        return name
+    return name + ':' + entity
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(usage = 'python sweep.py [options] file_name')
+    parser.add_argument('file_name')
+    parser.add_argument('-p', '--parameter', action = 'append', default = [],
+                        metavar = 'NAME[:ENTITY]=V1,V2,...',
+                        help = 'values to sweep; NAME is one of ' + ', '.join(sorted(PARAMETERS)))
+    parser.add_argument('--repeat', type = int, default = 1,
+                        help = 'runs of each grid point, with different seeds')
+    parser.add_argument('--seed', type = int, default = 0,
+                        help = 'seed of the first run; run i uses seed + i')
+    parser.add_argument('--processes', type = int, default = None,
+                        help = 'worker processes (default: one per core)')
+    parser.add_argument('--scheduler', choices = sorted(simulator.schedulers), default = 'heap')
+    parser.add_argument('--fluid', type = int, metavar = 'BYTES',
+                        help = 'model TCP messages of at least BYTES bytes as fluid flows')
+    parser.add_argument('--sniffers', metavar = 'DIR',
+                        help = 'keep sniffer logs under DIR/run-N (default: discard them)')
+    parser.add_argument('-o', '--output', help = 'results file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    parameters = [parse_parameter(option) for option in args.parameter]
+    keys       = [key for key, values in parameters]
+    operations = simulator.Reader(args.file_name).operations()
+
+    jobs = []
+    for variant in expand_grid(parameters):
+        for each in range(args.repeat):
+            run = len(jobs)
+            jobs.append((run, args.seed + run, variant, operations, args.scheduler, args.fluid,
+                         args.sniffers))
+
+    output = sys.stdout
+    if args.output:
+        output = open(args.output, 'w')
+
+    output.write('\t'.join(['run', 'seed'] + [format_key(key) for key in keys] + METRICS) + '\n')
+    pool = multiprocessing.Pool(args.processes)
+    try:
+        for run, seed, variant, metrics in pool.imap(run_variant, jobs):
+            row  = [str(run), str(seed)] + [variant[key] for key in keys]
+            row += [str(metrics[metric]) for metric in METRICS]
+            output.write('\t'.join(row) + '\n')
+            output.flush()
+    finally:
+        pool.close()
+        pool.join()
+
+    if args.output:
+        output.close()
+
+
+if __name__ == '__main__':
+    main()
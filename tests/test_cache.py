@@ -0,0 +1,44 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import simulator
+
+
+class ScenarioCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache   = tempfile.mkdtemp()
+        self.compile = simulator.Reader.compile
+        self.parsed  = []
+
+        def compile(reader, entry):
+            self.parsed.append(reader.file_name)
+            return self.compile(reader, entry)
+
+        simulator.Reader.compile = compile
+
+    def tearDown(self):
+        simulator.Reader.compile = self.compile
+        shutil.rmtree(self.cache)
+
+    # The first load parses the entry and keeps its operations; the second
+    # runs them from the cache.
+    def test_miss_then_hit(self):
+        entry = os.path.join(ROOT, 'entry.txt')
+        first = simulator.Reader(entry, self.cache).operations()
+        self.assertEqual(len(self.parsed), 1)
+        self.assertEqual(len([name for name in os.listdir(self.cache)
+                              if name.endswith('.scenario')]), 1)
+
+        second = simulator.Reader(entry, self.cache).operations()
+        self.assertEqual(len(self.parsed), 1)
+        self.assertEqual(second, first)
+
+
+if __name__ == '__main__':
+    unittest.main()
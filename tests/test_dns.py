@@ -0,0 +1,106 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+try:
+    from StringIO import StringIO
+except ImportError: # Python 3
+    from io import StringIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import simulator
+
+
+# h0 asks the DNS server at h2 for h1 and for a name no host has, twice
+# at once, again while the answers are cached, and again after they
+# expire (Resolver.NEGATIVE_TTL for the missing name, Resolver.TTL for h1).
+LOOKUPS = """
+set h0 [$simulator host]
+set h1 [$simulator host]
+set h2 [$simulator host]
+set r0 [$simulator router 3]
+$simulator duplex-link $h0 $r0.0 10Mbps 1ms
+$simulator duplex-link $r0.1 $h1 10Mbps 1ms
+$simulator duplex-link $r0.2 $h2 10Mbps 1ms
+$simulator $h0 10.0.0.1 10.0.0.2 10.0.2.1
+$simulator $h1 10.0.1.1 10.0.1.2 10.0.2.1
+$simulator $h2 10.0.2.1 10.0.2.2 1.1.1.1
+$simulator $r0 0 10.0.0.2 1 10.0.1.2 2 10.0.2.2
+$simulator $r0 route 10.0.0.0 0 10.0.1.0 1 10.0.2.0 2
+$simulator $r0 performance 100us 0 1000 1 1000 2 1000
+set httpc0 [new Agent/HTTPClient]
+set https1 [new Agent/HTTPServer]
+set dns2 [new Agent/DNSServer]
+$simulator attach-agent $httpc0 $h0
+$simulator attach-agent $https1 $h1
+$simulator attach-agent $dns2 $h2
+$simulator at 0.5 "httpc0 GET h1"
+$simulator at 0.5 "httpc0 GET h1"
+$simulator at 0.5 "httpc0 GET nowhere"
+$simulator at 0.6 "httpc0 GET nowhere"
+$simulator at 10.0 "httpc0 GET h1"
+$simulator at 10.0 "httpc0 GET nowhere"
+$simulator at 40.0 "httpc0 GET nowhere"
+$simulator at 400.0 "httpc0 GET h1"
+$simulator at 401.0 "finish"
+"""
+
+
+class ResolverTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'entry.txt')
+            with open(path, 'w') as f:
+                f.write(LOOKUPS)
+            self.sim = simulator.Simulator('heap', 1)
+            self.sim.load(path)
+        finally:
+            shutil.rmtree(directory)
+
+        self.queries  = []
+        self.requests = []
+        self.sim.tracer.subscribe('network.send', self.queries.append,
+                                  where = {'entity' : 'h0', 'dport' : 53})
+        self.sim.tracer.subscribe('transport.send', self.requests.append,
+                                  where = {'entity' : 'h0', 'type' : 'HTTP command'})
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            self.sim.run()
+        finally:
+            self.output, sys.stdout = sys.stdout.getvalue(), stdout
+
+    def tearDown(self):
+        self.sim.tracer.unsubscribe(self.queries.append)
+        self.sim.tracer.unsubscribe(self.requests.append)
+
+    # Lookups of a name already asked for wait for the same answer; cached
+    # answers are used until they expire.
+    def test_queries(self):
+        self.assertEqual([record['time'] for record in self.queries], [0.5, 0.5, 40.0, 400.0])
+        resolver = self.sim.get('h0').resolver
+        self.assertEqual(resolver.waiting, {})
+        self.assertEqual(sorted(resolver.answers), ['h1', 'nowhere'])
+
+    def test_answers(self):
+        times = [record['time'] for record in self.requests]
+        self.assertEqual(len(times), 4)
+        self.assertTrue(times[0] == times[1] > 0.5)
+        self.assertEqual(times[2], 10.0) # from the cache, at once
+        self.assertTrue(times[3] > 400.0)
+
+    # Every lookup of the missing name fails, those answered from the
+    # cache too.
+    def test_negative_answers(self):
+        self.assertEqual(self.output.count('host nowhere desconhecido'), 4)
+        ip, expiry = self.sim.get('h0').resolver.answers['nowhere']
+        self.assertEqual(ip, None)
+        self.assertTrue(40.0 + simulator.Resolver.NEGATIVE_TTL < expiry <
+                        41.0 + simulator.Resolver.NEGATIVE_TTL)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import simulator
+
+
+# Stands for the client agent a generator drives: keeps its commands.
+class Client:
+    identifier = 'c0'
+
+    def __init__(self):
+        self.commands = []
+
+    def do(self, time, command):
+        self.commands.append((time, command.split()))
+
+
+class GeneratorTest(unittest.TestCase):
+    def setUp(self):
+        self.sim      = simulator.Simulator('heap', 7)
+        self.previous = self.sim.activate()
+        self.client   = simulator.Generator('g0').agent = Client()
+
+    def tearDown(self):
+        simulator.Simulator.active = self.previous
+
+    # Runs the generator commands, at the given times, until `stop`.
+    def run_commands(self, commands, stop):
+        for time, command in commands:
+            simulator.Event("order", time, 'g0 ' + command)
+        simulator.Event("order", stop, 'g0 stop')
+        self.sim.run()
+
+        generator = self.sim.get('g0')
+        self.assertEqual(generator.requests, len(self.client.commands))
+        self.assertTrue(max(time for time, command in self.client.commands) < stop)
+        return [command[2] for time, command in self.client.commands]
+
+    # Counts within 4 standard deviations of the expected ones.
+    def assertAbout(self, count, expected, deviation):
+        self.assertTrue(abs(count - expected) < 4 * deviation, (count, expected))
+
+    def test_poisson(self):
+        servers = self.run_commands([(0.0, 'poisson 100 GET h1 /index.html')], 100.0)
+        self.assertAbout(len(servers), 10000, 100)
+        self.assertEqual(self.client.commands[0][1], ['c0', 'GET', 'h1', '/index.html'])
+
+    # On a quarter of the time: 500 cycles of 0.5 s on and 1.5 s off.
+    def test_onoff(self):
+        servers = self.run_commands([(0.0, 'onoff 100 0.5 1.5 GET h1')], 1000.0)
+        self.assertAbout(len(servers), 25000, 1200)
+
+    def test_zipf(self):
+        servers = self.run_commands([(0.0, 'zipf 1.0'),
+                                     (0.0, 'poisson 100 GET h1,h2,h3')], 100.0)
+        total = 1.0 + 1.0 / 2 + 1.0 / 3
+        for k, server in enumerate(['h1', 'h2', 'h3']):
+            share = 1.0 / (k + 1) / total
+            self.assertAbout(servers.count(server), share * len(servers),
+                             (share * (1 - share) * len(servers)) ** 0.5)
+
+    # A new command replaces the running process.
+    def test_restart(self):
+        servers = self.run_commands([(0.0, 'poisson 100 GET h1'),
+                                     (50.0, 'poisson 100 GET h2')], 100.0)
+        self.assertAbout(servers.count('h1'), 5000, 71)
+        self.assertAbout(servers.count('h2'), 5000, 71)
+        self.assertEqual(servers.index('h2'), servers.count('h1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import simulator
+
+
+class PortAllocatorTest(unittest.TestCase):
+    def setUp(self):
+        self.ports = simulator.TransportLayer.PORTS
+        simulator.TransportLayer.PORTS = (1024, 1033) # ten ports
+        self.sim      = simulator.Simulator('heap', 3)
+        self.previous = self.sim.activate()
+        self.layer    = simulator.Host('h0').transport_layer
+
+    def tearDown(self):
+        simulator.Simulator.active     = self.previous
+        simulator.TransportLayer.PORTS = self.ports
+
+    def test_exhaustion(self):
+        ports = [self.layer.get_unused_port() for each in range(10)]
+        self.assertEqual(sorted(ports), list(range(1024, 1034)))
+        self.assertRaises(RuntimeError, self.layer.get_unused_port)
+
+        self.layer.release_port(1030)
+        self.assertEqual(self.layer.get_unused_port(), 1030)
+
+    # Past the last port the search goes on from the first one.
+    def test_wrap_around(self):
+        for seed in range(5):
+            self.layer.host.random.seed(seed)
+            self.layer.ports = set(range(1025, 1034))
+            self.assertEqual(self.layer.get_unused_port(), 1024)
+
+    # The port of a closed connection is only free again once its TIME
+    # WAIT is over.
+    def test_reuse_after_time_wait(self):
+        for each in range(10):
+            self.layer.get_unused_port()
+        flow = self.layer.new_flow('10.0.0.1', 1031, 80, "TIME WAIT", 0)
+        self.layer.time_wait.append((simulator.TransportLayer.TIME_WAIT, flow))
+
+        self.sim.time = simulator.TransportLayer.TIME_WAIT - 1.0
+        self.assertRaises(RuntimeError, self.layer.get_unused_port)
+        self.sim.time = simulator.TransportLayer.TIME_WAIT
+        self.assertEqual(self.layer.get_unused_port(), 1031)
+        self.assertFalse(flow.key in self.layer.connections)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import os
+import sys
+import timeit
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import simulator
+
+
+class PacketQueueTimingTest(unittest.TestCase):
+    # A burst of n packets behind a train of n, none of them dropped.
+    def burst(self, n):
+        queue = simulator.PacketQueue(4 * n)
+        queue.push(simulator.Train(list(range(n)), [1e-6 * k for k in range(n)]), 0.0, 1e-3)
+        for k in range(n):
+            queue.push(k, 1e-6 * k, 1e-3)
+        self.assertEqual(queue.enqueued, 2 * n)
+
+    # Pushing takes about the same time per packet however deep the queue
+    # is: 16 times the packets may not take 64 times as long (a scan of the
+    # queue on every push took about 200 times as long).
+    def test_push_does_not_scan_the_queue(self):
+        small = min(timeit.repeat(lambda: self.burst(1000), number = 1, repeat = 3))
+        large = min(timeit.repeat(lambda: self.burst(16000), number = 1, repeat = 3))
+        self.assertTrue(large < 64 * small, (small, large))
+        self.assertTrue(large < 2.0, large)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import simulator
+
+
+TWO_HOSTS = """
+set h0 [$simulator host]
+set h1 [$simulator host]
+set r0 [$simulator router 2]
+$simulator duplex-link $h0 $r0.0 10Mbps 1ms
+$simulator duplex-link $r0.1 $h1 10Mbps 1ms
+$simulator $h0 10.0.0.1 10.0.0.2 1.1.1.1
+$simulator $h1 10.0.1.1 10.0.1.2 1.1.1.1
+$simulator $r0 0 10.0.0.2 1 10.0.1.2
+$simulator $r0 route 10.0.0.0 0 10.0.1.0 1
+$simulator at 1.0 "finish"
+"""
+
+
+def load(text):
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'entry.txt')
+        with open(path, 'w') as f:
+            f.write(text)
+        sim = simulator.Simulator('heap', 1)
+        sim.load(path)
+    finally:
+        shutil.rmtree(directory)
+    return sim
+
+
+class PathTest(unittest.TestCase):
+    def test_path_to(self):
+        sim       = load(TWO_HOSTS)
+        transport = sim.get('h0').transport_layer
+        self.assertEqual(len(transport.path_to('10.0.1.1')), 2)
+        self.assertEqual(transport.path_to('172.16.0.1'), None) # no route at r0
+        self.assertEqual(transport.path_to('10.0.1.7'), None)   # routed, but no such host
+
+
+# Overlapping prefixes, some of them through gateways (one of which is
+# reached through another gateway).
+OVERLAPPING = """
+set r0 [$simulator router 4]
+$simulator $r0 0 10.0.0.1 1 10.1.0.1 2 10.1.2.1 3 192.168.0.1
+$simulator $r0 route 0.0.0.0/0 3 10.0.0.0/8 0 10.1.0.0/16 1 10.1.2.0 2 \\
+                     10.1.2.128/25 10.0.5.1 10.9.0.0/16 10.1.2.200
+$simulator at 1.0 "finish"
+"""
+
+
+class LongestPrefixTest(unittest.TestCase):
+    def interfaces(self, text, destinations):
+        router = load(text).get('r0')
+        router.compile_table()
+        return [router.get_interface_from_table(ip) for ip in destinations]
+
+    def test_overlapping_prefixes(self):
+        self.assertEqual(self.interfaces(OVERLAPPING, ['10.1.2.1', '10.1.2.127', '10.1.3.1',
+                                                       '10.2.0.1', '8.8.8.8']),
+                         [2, 2, 1, 0, 3])
+
+    def test_gateways(self):
+        # 10.1.2.200 is in the /25, which goes through 10.0.5.1, in the /8.
+        self.assertEqual(self.interfaces(OVERLAPPING, ['10.1.2.128', '10.1.2.255', '10.9.8.7']),
+                         [0, 0, 0])
+
+    def test_gateway_loop(self):
+        text = OVERLAPPING.replace('10.9.0.0/16 10.1.2.200', '10.9.0.0/16 10.9.0.1')
+        self.assertRaises(ValueError, self.interfaces, text, [])
+
+    # The trie gives the value of the longest prefix that matches, as a
+    # scan of all the prefixes does.
+    def test_trie_against_scan(self):
+        generator = random.Random(5)
+        trie      = simulator.PrefixTrie()
+        prefixes  = {}
+        for value in range(300):
+            length  = generator.choice([0, 8, 12, 16, 20, 24, 25, 30, 32])
+            network = generator.getrandbits(32) & ~((1 << (32 - length)) - 1) & 0xffffffff
+            network = network & 0xff0fffff # keep many of them overlapping
+            trie.add(network, length, value)
+            prefixes[(network, length)] = value
+
+        for each in range(3000):
+            address = generator.getrandbits(32) & 0xff0fffff
+            matches = [(length, value) for (network, length), value in prefixes.items()
+                       if address >> (32 - length) == network >> (32 - length)]
+            if matches:
+                self.assertEqual(trie.lookup(address), max(matches)[1])
+            else:
+                self.assertRaises(KeyError, trie.lookup, address)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import heapq
+import os
+import random
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import simulator
+
+
+# What the schedulers read of an event.
+class Item:
+    def __init__(self, time, identifier):
+        self.time       = time
+        self.identifier = identifier
+
+
+class CalendarSchedulerTest(unittest.TestCase):
+    # Pushes and pops as in a simulation (every popped event schedules up to
+    # two later ones), comparing each pop with a heap of (time, identifier).
+    def check(self, delays, seed):
+        generator = random.Random(seed)
+        calendar  = simulator.CalendarScheduler()
+        heap      = []
+        count     = [0]
+
+        def push(time):
+            count[0] += 1
+            calendar.push(Item(time, count[0]))
+            heapq.heappush(heap, (time, count[0]))
+
+        for each in range(200):
+            push(delays(generator))
+        now = 0.0
+        while heap:
+            self.assertEqual(calendar.next_time(), heap[0][0])
+            event = calendar.pop()
+            time, identifier = heapq.heappop(heap)
+            self.assertEqual((event.time, event.identifier), (time, identifier))
+            self.assertTrue(event.time >= now)
+            now = event.time
+            if count[0] < 20000:
+                for each in range(generator.choice([0, 1, 1, 2])):
+                    push(now + delays(generator))
+            self.assertEqual(len(calendar), len(heap))
+
+    def test_uniform_delays(self):
+        self.check(lambda generator: generator.uniform(0, 10), 1)
+
+    def test_skewed_delays(self):
+        self.check(lambda generator: generator.expovariate(1.0) ** 3, 2)
+
+    # Many events at the same times leave in the order they were pushed.
+    def test_ties(self):
+        self.check(lambda generator: float(generator.randrange(3)), 3)
+
+    def test_far_events(self):
+        self.check(lambda generator: generator.choice([1e-6, 1e-3, 1.0, 1e4]), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import simulator
+
+
+# A client behind a 2Mbps link fetching the index page twice: nothing is
+# lost, so nothing should be sent again.
+LOSSLESS = """
+set h0 [$simulator host]
+set h1 [$simulator host]
+set r0 [$simulator router 2]
+$simulator duplex-link $h0 $r0.0 10Mbps 10ms
+$simulator duplex-link $r0.1 $h1 2Mbps 20ms
+$simulator $h0 10.0.0.1 10.0.0.2 1.1.1.1
+$simulator $h1 10.0.1.1 10.0.1.2 1.1.1.1
+$simulator $r0 0 10.0.0.2 1 10.0.1.2
+$simulator $r0 route 10.0.0.0 0 10.0.1.0 1
+$simulator $r0 performance 100us 0 1000 1 1000
+set httpc0 [new Agent/HTTPClient]
+set https1 [new Agent/HTTPServer]
+$simulator attach-agent $httpc0 $h0
+$simulator attach-agent $https1 $h1
+$simulator at 0.5 "httpc0 GET 10.0.1.1 %(page)s"
+$simulator at 0.6 "httpc0 GET 10.0.1.1 %(page)s"
+$simulator at 30.0 "finish"
+"""
+
+
+class LosslessTransferTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.records   = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_scenario(self, sim, text):
+        path = os.path.join(self.directory, 'entry.txt')
+        with open(path, 'w') as f:
+            f.write(text)
+        sim.load(path)
+        sim.run()
+        return sim
+
+    def test_no_retransmissions(self):
+        page = os.path.join(ROOT, 'http_index.txt')
+        sim  = simulator.Simulator('heap', 1)
+        sim.tracer.subscribe('tcp.retransmit,tcp.ack', self.records.append)
+        self.run_scenario(sim, LOSSLESS % {'page' : page})
+        sim.tracer.unsubscribe(self.records.append)
+
+        acks = [record['ack'] for record in self.records
+                if record['point'] == 'tcp.ack' and record['entity'] == 'h1']
+        self.assertEqual([record for record in self.records
+                          if record['point'] == 'tcp.retransmit'], [])
+        self.assertEqual(sim.summary()['dropped_packets'], 0)
+        self.assertTrue(max(acks) > os.path.getsize(page))
+
+    # A subscription only sees the calls of its own simulator.
+    def test_tracing_is_per_simulator(self):
+        page   = os.path.join(ROOT, 'http_index.txt')
+        traced = simulator.Simulator('heap', 1)
+        traced.tracer.subscribe('tcp.ack', self.records.append)
+        try:
+            self.run_scenario(simulator.Simulator('heap', 1), LOSSLESS % {'page' : page})
+            self.assertEqual(self.records, [])
+            self.run_scenario(traced, LOSSLESS % {'page' : page})
+            self.assertNotEqual(self.records, [])
+        finally:
+            traced.tracer.unsubscribe(self.records.append)
+        self.assertEqual(simulator.trace_listeners['tcp.ack'], 0)
+
+
+class PacketQueueTest(unittest.TestCase):
+    # The packets of a train are dropped exactly as if each had come alone
+    # at its own arrival time.
+    def test_train_admitted_per_packet(self):
+        times = [0.001 * k for k in range(20)]
+        delay = 0.0025
+
+        alone = simulator.PacketQueue(3)
+        kept  = [k for k, time in enumerate(times) if alone.push(k, time, delay) is not None]
+
+        queue = simulator.PacketQueue(3)
+        train = queue.push(simulator.Train(list(range(20)), list(times)), times[0], delay)
+        self.assertEqual(train.items, kept)
+        self.assertEqual(queue.dropped, alone.dropped)
+        self.assertEqual(queue.pop()[1], [alone.pop()[1][0] for k in kept])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Queries over the column traces written by 'columns' sniffers:
+#
+#   $simulator attach-agent $sniffer1 $r0.2 $r1.0 "/tmp/trace1" columns
+#
+#   import traces
+#   t = traces.Trace('/tmp/trace1')
+#   tcp = t.filter(protocol = 6, dst = '192.168.1.3')
+#   tcp.group_by(['src', 'sport', 'dst', 'dport'], 'size', 'sum')
+#   t.window(0.1, 'size', 'sum')
+#
+# Operations work on whole columns at once with NumPy when it is installed,
+# and fall back to plain Python loops over the arrays when it is not.
+#
+#   python traces.py /tmp/trace1 --by src,dst --window 0.1
+
+import os
+import sys
+import array
+import argparse
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import simulator
+
+AGGREGATES = ['count', 'sum', 'min', 'max', 'mean']
+
+
+def int_to_ip(value):
+    return '.'.join(str((int(value) >> shift) & 0xff) for shift in (24, 16, 8, 0))
+
+
+def read_column(path, typecode, swap):
+    size = os.path.getsize(path)
+    if numpy is not None:
+        column = numpy.fromfile(path, dtype = numpy.dtype(typecode))
+        if swap:
+            column = column.byteswap()
+        return column
+
+    column = array.array(typecode)
+    f = open(path, 'rb')
+    column.fromfile(f, size // column.itemsize)
+    f.close()
+    if swap:
+        column.byteswap()
+    return column
+
+
+class Trace:
+    def __init__(self, directory = None, columns = None):
+        if columns is None:
+            columns = Trace.load(directory)
+        self.columns = columns
+
+    @staticmethod
+    def load(directory):
+        f = open(os.path.join(directory, 'columns'))
+        byteorder = f.readline().strip()
+        layout    = [line.split() for line in f if line.strip()]
+        f.close()
+
+        columns = {}
+        for name, typecode, itemsize in layout:
+            if array.array(typecode).itemsize != int(itemsize):
+                raise ValueError('column ' + name + ' has ' + itemsize +
+                                 ' byte items, expected ' + str(array.array(typecode).itemsize))
+            columns[name] = read_column(os.path.join(directory, name), typecode,
+                                        byteorder != sys.byteorder)
+
+        # A trace being written may have a batch only partly on disk.
+        rows = min(len(column) for column in columns.values())
+        for name in columns:
+            columns[name] = columns[name][:rows]
+        return columns
+
+    def __len__(self):
+        return len(self.columns['time'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __iter__(self):
+        names = [name for name, typecode in simulator.TRACE_COLUMNS]
+        for row in zip(*[self.columns[name] for name in names]):
+            yield dict(zip(names, row))
+
+    # Rows selected by a boolean sequence, one entry per row.
+    def where(self, mask):
+        if numpy is not None:
+            mask = numpy.asarray(mask, dtype = bool)
+            return Trace(columns = dict((name, column[mask])
+                                        for name, column in self.columns.items()))
+
+        rows = [k for k, keep in enumerate(mask) if keep]
+        return Trace(columns = dict((name, array.array(column.typecode, [column[k] for k in rows]))
+                                    for name, column in self.columns.items()))
+
+    # Rows whose columns are equal to the given values. IP addresses may be
+    # given as strings and a list of values matches any of them.
+    def filter(self, **conditions):
+        mask = None
+        for name, value in conditions.items():
+            if not isinstance(value, (list, tuple, set)):
+                value = [value]
+            value = [simulator.ip_to_int(v) if isinstance(v, str) else v for v in value]
+
+            column = self.columns[name]
+            if numpy is not None:
+                match = numpy.isin(column, value)
+                mask  = match if mask is None else mask & match
+            else:
+                value = set(value)
+                match = [v in value for v in column]
+                mask  = match if mask is None else [a and b for a, b in zip(mask, match)]
+
+        if mask is None:
+            return self
+        return self.where(mask)
+
+    # Rows with start <= time < end.
+    def between(self, start, end):
+        time = self.columns['time']
+        if numpy is not None:
+            return self.where((time >= start) & (time < end))
+        return self.where([start <= t < end for t in time])
+
+    # Aggregates a column (or just counts rows) for every distinct value of
+    # the key columns: {key tuple: value}.
+    def group_by(self, keys, column = None, aggregate = 'count'):
+        if isinstance(keys, str):
+            keys = [keys]
+        return self.aggregate([self.columns[key] for key in keys], column, aggregate)
+
+    # Aggregates over consecutive time windows of the given width:
+    # [(window start, value)], only for windows with rows.
+    def window(self, width, column = None, aggregate = 'count'):
+        time = self.columns['time']
+        if numpy is not None:
+            bins = numpy.floor(time / width).astype(numpy.int64)
+        else:
+            bins = [int(t // width) for t in time]
+        result = self.aggregate([bins], column, aggregate)
+        return [(key[0] * width, value) for key, value in sorted(result.items())]
+
+    def aggregate(self, keys, column, aggregate):
+        if not aggregate in AGGREGATES:
+            raise ValueError('unknown aggregate ' + aggregate + ' (expected one of ' +
+                             ', '.join(AGGREGATES) + ')')
+        if column is None:
+            column, aggregate = 'time', 'count'
+        values = self.columns[column]
+        if not len(values):
+            return {}
+
+        if numpy is not None:
+            return numpy_aggregate(keys, values, aggregate)
+
+        groups = {}
+        for key, value in zip(zip(*keys), values):
+            groups.setdefault(key, []).append(value)
+        functions = {'count' : len,
+                     'sum'   : sum,
+                     'min'   : min,
+                     'max'   : max,
+                     'mean'  : lambda v: float(sum(v)) / len(v)}
+        return dict((key, functions[aggregate](v)) for key, v in groups.items())
+
+
+def numpy_aggregate(keys, values, aggregate):
+    # Sorts the rows by key so each group is a contiguous run.
+    order  = numpy.lexsort(keys[::-1])
+    keys   = [numpy.asarray(key)[order] for key in keys]
+    values = numpy.asarray(values)[order]
+
+    changed = numpy.zeros(len(values), dtype = bool)
+    changed[0] = True
+    for key in keys:
+        changed[1:] |= key[1:] != key[:-1]
+    starts = numpy.flatnonzero(changed)
+    counts = numpy.diff(numpy.append(starts, len(values)))
+
+    if aggregate == 'count':
+        result = counts
+    elif aggregate == 'min':
+        result = numpy.minimum.reduceat(values, starts)
+    elif aggregate == 'max':
+        result = numpy.maximum.reduceat(values, starts)
+    else:
+        # Wide accumulators, the columns themselves may be bytes.
+        if values.dtype.kind in 'iu':
+            values = values.astype(numpy.int64)
+        result = numpy.add.reduceat(values, starts)
+        if aggregate == 'mean':
+            result = result / counts.astype(numpy.float64)
+
+    return dict((tuple(key[start].item() for key in keys), value.item())
+                for start, value in zip(starts, result))
+
+
+def format_key(names, key):
+    return [int_to_ip(value) if name in ('src', 'dst') else str(value)
+            for name, value in zip(names, key)]
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(usage = 'python traces.py [options] directory')
+    parser.add_argument('directory')
+    parser.add_argument('--by', default = 'src,sport,dst,dport,protocol',
+                        help = 'key columns of the flow table (default: the five-tuple)')
+    parser.add_argument('--window', type = float,
+                        help = 'also print frames and bytes per window of this many seconds')
+    args = parser.parse_args(argv)
+
+    trace = Trace(args.directory)
+    names = args.by.split(',')
+
+    frames = trace.group_by(names)
+    size   = trace.group_by(names, 'size', 'sum')
+    first  = trace.group_by(names, 'time', 'min')
+    last   = trace.group_by(names, 'time', 'max')
+    print('\t'.join(names + ['frames', 'bytes', 'first', 'last']))
+    for key in sorted(frames):
+        print('\t'.join(format_key(names, key) +
+                        [str(frames[key]), str(size[key]), repr(first[key]), repr(last[key])]))
+
+    if args.window:
+        size = dict(trace.window(args.window, 'size', 'sum'))
+        print('')
+        print('\t'.join(['window', 'frames', 'bytes']))
+        for start, count in trace.window(args.window):
+            print('\t'.join([repr(start), str(count), str(size[start])]))
+
+
+if __name__ == '__main__':
+    main()